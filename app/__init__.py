@@ -1,10 +1,21 @@
 import os
-from flask import Flask, request, session
+import threading
+from functools import lru_cache
+from flask import Flask, request, session, current_app
 from flask_login import LoginManager
 from dotenv import load_dotenv
-from flask_babel import Babel
-from apscheduler.schedulers.background import BackgroundScheduler
-from app.scheduler import refresh_all_accounts_job
+from flask_babel import Babel, force_locale, get_translations, get_locale as babel_get_locale
+from werkzeug.datastructures import LanguageAccept
+from werkzeug.http import parse_accept_header
+
+# Process roles selected with APP_MODE:
+#   all     serve requests and run the scheduler (default)
+#   web     serve requests only, e.g. when several web workers are started
+#   worker  run the scheduler as soon as the app is created
+APP_MODES = ('all', 'web', 'worker')
+
+# Guards against two concurrent first requests starting two schedulers
+_scheduler_lock = threading.Lock()
 
 # Initialize the authentication manager
 login_manager = LoginManager()
@@ -15,23 +26,68 @@ babel = Babel()
 
 # Function to determine which language to use
 def get_locale():
-    # Priority 1: Try to get the language from the session (for current session)
-    if 'language' in session:
+    # This runs on every request: it only reads the request and never writes
+    # the session, so public pages don't get a Set-Cookie and stay cacheable
+    languages = current_app.config['LANGUAGES']
+
+    # Priority 1: Check for the persistent cookie
+    language = request.cookies.get('user_language')
+    if language in languages:
+        return language
+
+    # Priority 2: Language stored in the session by older versions
+    if 'language' in session and session['language'] in languages:
         return session['language']
-    
-    # Priority 2: Check for the persistent cookie
-    if request.cookies.get('user_language'):
-        language = request.cookies.get('user_language')
-        # If cookie exists but it's not a supported language, don't use it
-        if language in ['fr', 'en', 'de', 'cs', 'eo']:
-            # Update the session with the cookie value for consistency
-            session['language'] = language
-            return language
-    
+
     # Priority 3: Use the best match with browser preferences
-    return request.accept_languages.best_match(['fr', 'en', 'de', 'cs', 'eo'])
+    return best_language_match(request.headers.get('Accept-Language', ''), tuple(languages))
+
+@lru_cache(maxsize=256)
+def best_language_match(accept_language, languages):
+    """Best supported language for an Accept-Language header (few distinct values in practice)"""
+    return parse_accept_header(accept_language, LanguageAccept).best_match(languages)
+
+def current_language():
+    """Language code of the current request, for templates"""
+    return str(babel_get_locale() or current_app.config['BABEL_DEFAULT_LOCALE'])
+
+def add_language_vary(response):
+    """Tell HTTP caches which request headers select the page language"""
+    if response.mimetype == 'text/html':
+        response.vary.add('Accept-Language')
+        response.vary.add('Cookie')
+    return response
+
+def preload_translations(app):
+    """Load every translation catalog once, instead of on the first request for each language"""
+    with app.test_request_context():
+        for language in app.config['LANGUAGES']:
+            with force_locale(language):
+                get_translations()
+
+def start_scheduler(app):
+    """Start the background scheduler (imports APScheduler and the Nordigen SDK)"""
+    if 'scheduler' in app.extensions:
+        return app.extensions['scheduler']
+
+    with _scheduler_lock:
+        if 'scheduler' in app.extensions:
+            return app.extensions['scheduler']
+
+        # Heavy imports are deferred until the scheduler is actually needed
+        from apscheduler.schedulers.background import BackgroundScheduler
+        from app.scheduler import refresh_all_accounts_job, instance_maintenance_job
 
-def create_app():
+        sched = BackgroundScheduler(daemon=True)
+        # Schedule the job to run every day at 3 AM
+        sched.add_job(refresh_all_accounts_job,'cron', hour=3, minute=42, id='refresh_all_accounts_job', replace_existing=True, args=[app])
+        # Prune and compact the instance folder every week, after the refresh
+        sched.add_job(instance_maintenance_job, 'cron', day_of_week='sun', hour=4, minute=30, id='instance_maintenance_job', replace_existing=True, args=[app])
+        sched.start()
+        app.extensions['scheduler'] = sched
+    return sched
+
+def create_app(test_config=None):
     # Create the Flask application
     app = Flask(__name__, instance_relative_config=True)
     
@@ -50,7 +106,46 @@ def create_app():
         SECRET_KEY=os.environ.get('SECRET_KEY', 'dev'),
         DATABASE=os.path.join(app.instance_path, 'association.sqlite'),
         DEBUG=os.environ.get('DEBUG', 'False').lower() in ('true', '1', 't'),
+        # Response compression (see app/compression.py)
+        COMPRESS_ENABLED=os.environ.get('COMPRESS_ENABLED', 'True').lower() in ('true', '1', 't'),
+        COMPRESS_MIN_SIZE=int(os.environ.get('COMPRESS_MIN_SIZE', 500)),
+        COMPRESS_LEVEL=int(os.environ.get('COMPRESS_LEVEL', 6)),
+        COMPRESS_CACHE_SIZE=int(os.environ.get('COMPRESS_CACHE_SIZE', 64)),
+        # Seconds a user loaded by Flask-Login is kept in memory
+        USER_CACHE_TTL=int(os.environ.get('USER_CACHE_TTL', 300)),
+        APP_MODE=os.environ.get('APP_MODE', 'all').lower(),
+        # Shared HTTP connection pool for the Nordigen API (see app/nordigen_client.py)
+        NORDIGEN_POOL_SIZE=int(os.environ.get('NORDIGEN_POOL_SIZE', 10)),
+        NORDIGEN_POOL_BLOCK=os.environ.get('NORDIGEN_POOL_BLOCK', 'True').lower() in ('true', '1', 't'),
+        NORDIGEN_CONNECT_TIMEOUT=float(os.environ.get('NORDIGEN_CONNECT_TIMEOUT', 5)),
+        NORDIGEN_READ_TIMEOUT=float(os.environ.get('NORDIGEN_READ_TIMEOUT', 30)),
+        NORDIGEN_BASE_URL=os.environ.get('NORDIGEN_BASE_URL'),
+        # Fetch bank data with concurrent async calls (see app/nordigen_async.py)
+        NORDIGEN_ASYNC=os.environ.get('NORDIGEN_ASYNC', 'False').lower() in ('true', '1', 't'),
+        # Sync pipeline: concurrent API fetches, concurrent store writes, users per batch (see app/sync.py)
+        SYNC_FETCH_WORKERS=int(os.environ.get('SYNC_FETCH_WORKERS', os.environ.get('NORDIGEN_POOL_SIZE', 10))),
+        SYNC_PUBLISH_WORKERS=int(os.environ.get('SYNC_PUBLISH_WORKERS', 4)),
+        SYNC_BATCH_SIZE=int(os.environ.get('SYNC_BATCH_SIZE', 25)),
+        # Static export of the public transparency pages (see app/export.py)
+        TRANSPARENCY_EXPORT_DIR=os.environ.get('TRANSPARENCY_EXPORT_DIR'),
+        TRANSPARENCY_EXPORT_PAGE_SIZE=int(os.environ.get('TRANSPARENCY_EXPORT_PAGE_SIZE', 100)),
+        # Public JSON API: requests per second and burst size per client (see app/api.py)
+        API_RATE_LIMIT=float(os.environ.get('API_RATE_LIMIT', 5)),
+        API_RATE_BURST=int(os.environ.get('API_RATE_BURST', 30)),
+        # Reverse proxies in front of the app whose X-Forwarded-* headers are trusted
+        PROXY_COUNT=int(os.environ.get('PROXY_COUNT', 0)),
+        # Opt-in sampling profiler, see /admin/profiler (app/profiling.py)
+        PROFILER_ENABLED=os.environ.get('PROFILER_ENABLED', 'False').lower() in ('true', '1', 't'),
+        PROFILER_SLOW_MS=int(os.environ.get('PROFILER_SLOW_MS', 1000)),
+        PROFILER_INTERVAL_MS=int(os.environ.get('PROFILER_INTERVAL_MS', 10)),
+        PROFILER_MAX_WINDOW=int(os.environ.get('PROFILER_MAX_WINDOW', 600)),
+        # Load all translation catalogs at startup
+        BABEL_PRELOAD=os.environ.get('BABEL_PRELOAD', 'True').lower() in ('true', '1', 't'),
     )
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+    if app.config['APP_MODE'] not in APP_MODES:
+        raise ValueError(f"APP_MODE must be one of {', '.join(APP_MODES)}")
       # Configure Babel for internationalization
     app.config['BABEL_DEFAULT_LOCALE'] = 'en'  # Default language: English
     # Use absolute path for translations directory
@@ -63,12 +158,47 @@ def create_app():
         'eo': 'Esperanto'
     }
     
+    # Behind a reverse proxy, take the client address (used by the API rate
+    # limiter), scheme and host from its X-Forwarded-* headers
+    if app.config['PROXY_COUNT']:
+        from werkzeug.middleware.proxy_fix import ProxyFix
+        count = app.config['PROXY_COUNT']
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=count, x_proto=count, x_host=count)
+
+    # Initialize the user and organisation store
+    from app import db
+    db.init_app(app)
+
     # Initialize the login manager
     login_manager.init_app(app)
     
     # Initialize Babel with the language selection function
     babel.init_app(app, locale_selector=get_locale)
-    
+    app.add_template_global(current_language)
+    app.after_request(add_language_vary)
+    if app.config['BABEL_PRELOAD']:
+        preload_translations(app)
+
+    # Compress responses and serve static assets with long-lived cache headers
+    from app import compression
+    compression.init_app(app)
+
+    # Request timing, slow request capture and sampling windows
+    from app import profiling
+    profiling.init_app(app)
+
+    # Retention and compaction of the instance folder
+    from app import maintenance
+    maintenance.init_app(app)
+
+    # Static export of the public transparency pages
+    from app import export
+    export.init_app(app)
+
+    # Staged sync of the bank accounts
+    from app import sync
+    sync.init_app(app)
+
     # Register blueprints
     from app.routes import main
     app.register_blueprint(main)
@@ -79,8 +209,24 @@ def create_app():
     from app.nordigen_api import nordigen_bp
     app.register_blueprint(nordigen_bp)
 
-    sched = BackgroundScheduler(daemon=True)
-    # Schedule the job to run every day at 3 AM
-    sched.add_job(refresh_all_accounts_job,'cron', hour=3, minute=42, id='refresh_all_accounts_job', replace_existing=True, args=[app])
-    sched.start()
+    from app import api
+    api.init_app(app)
+
+    if app.config['NORDIGEN_ASYNC']:
+        # Async views need httpx and Flask's async extra (asgiref)
+        from app import nordigen_async
+        nordigen_async.init_app(app)
+
+    # Tests and web-only processes never run the scheduler. Otherwise it is
+    # started right away, so the daily jobs run even if no request comes in.
+    # In debug mode it waits for the first request instead, so the debug
+    # reloader's watcher process doesn't start a second one.
+    if not app.testing and app.config['APP_MODE'] != 'web':
+        if app.config['APP_MODE'] == 'worker' or not app.debug:
+            start_scheduler(app)
+        else:
+            @app.before_request
+            def ensure_scheduler():
+                start_scheduler(app)
+
     return app
\ No newline at end of file
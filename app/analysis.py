@@ -0,0 +1,258 @@
+"""
+This module flags unusual transactions after each sync.
+
+Booked transactions are turned into columnar NumPy arrays and checked for:
+    duplicate     same account, date, amount and counterparty more than once
+    outlier       an outflow far above what is usually paid to a counterparty
+    balance_drop  a day whose outflows take a large share of the balance
+
+Only transactions not seen by a previous run are flagged, and per-counterparty
+statistics (count, mean, sum of squared deviations) are updated incrementally,
+so each run costs time proportional to the new transactions. State and results
+are kept in instance/analysis_<user_id>.json.
+"""
+import os
+import json
+import threading
+from datetime import date, datetime, timedelta
+from app.archive import transaction_date, transaction_key, to_minor_units
+
+# Keys of processed transactions are kept this long: the bank API only returns
+# the last 90 days, older transactions can't come back
+PROCESSED_RETENTION_DAYS = 120
+# Anomalies kept for the dashboard
+MAX_ANOMALIES = 200
+# Payments needed to a counterparty before its norm is trusted
+MIN_COUNTERPARTY_HISTORY = 5
+# Standard deviations above the counterparty mean to flag an outflow
+OUTLIER_Z_SCORE = 3.5
+# Share of the balance that one day of outflows must exceed to be flagged
+BALANCE_DROP_RATIO = 0.3
+
+_state_lock = threading.Lock()
+
+
+def _state_path(instance_path, user_id):
+    return os.path.join(instance_path, f'analysis_{user_id}.json')
+
+
+def load_state(instance_path, user_id):
+    """Get the analysis state (processed keys, counterparty stats, anomalies) of a user"""
+    state_path = _state_path(instance_path, user_id)
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass
+    return {'processed': {}, 'counterparties': {}, 'anomalies': []}
+
+
+def get_anomalies(instance_path, user_id):
+    """Anomalies found for a user, newest first"""
+    return load_state(instance_path, user_id)['anomalies']
+
+
+def _save_state(instance_path, user_id, state):
+    state_path = _state_path(instance_path, user_id)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def counterparty_name(tx):
+    """Who the money went to (outflows) or came from (inflows)"""
+    amount = tx.get('transactionAmount', {}).get('amount', '0')
+    if str(amount).startswith('-'):
+        return tx.get('creditorName') or ''
+    return tx.get('debtorName') or ''
+
+
+def closing_balance(account):
+    """Booked closing balance of an account in cents, or None"""
+    for balance in account.get('balances', []):
+        if balance.get('balanceType') == 'closingBooked':
+            return to_minor_units(balance.get('balanceAmount', {}).get('amount', 0))
+    return None
+
+
+def to_columns(accounts_data):
+    """Turn booked transactions into columnar arrays"""
+    import numpy as np
+
+    rows = []
+    for account_index, account in enumerate(accounts_data):
+        for tx in account.get('transactions', {}).get('booked', []):
+            tx_date = transaction_date(tx)
+            if tx_date:
+                rows.append((account_index, tx_date, tx))
+
+    transactions = [tx for _, _, tx in rows]
+    counterparties = [counterparty_name(tx) for tx in transactions]
+    codes, counterparty_codes = np.unique(np.array(counterparties, dtype=object), return_inverse=True) \
+        if rows else (np.array([], dtype=object), np.array([], dtype=np.int64))
+
+    return {
+        'transactions': transactions,
+        'keys': [transaction_key(tx) for tx in transactions],
+        'account': np.array([a for a, _, _ in rows], dtype=np.int64),
+        'date': np.array([date.fromisoformat(d).toordinal() for _, d, _ in rows], dtype=np.int64),
+        'amount': np.array([to_minor_units(tx.get('transactionAmount', {}).get('amount', 0))
+                            for tx in transactions], dtype=np.int64),
+        'counterparty': counterparty_codes.astype(np.int64),
+        'counterparty_names': codes,
+    }
+
+
+def _anomaly(kind, accounts_data, cols, i, **values):
+    tx = cols['transactions'][i]
+    account = accounts_data[int(cols['account'][i])]
+    return {
+        'type': kind,
+        'account_id': account.get('id'),
+        'account_name': account.get('name', 'Unknown account'),
+        'transaction_id': cols['keys'][i],
+        'date': transaction_date(tx),
+        'amount': tx.get('transactionAmount', {}).get('amount'),
+        'currency': tx.get('transactionAmount', {}).get('currency'),
+        'counterparty': counterparty_name(tx) or None,
+        # Figures behind the finding, the dashboard words them per language
+        **values,
+    }
+
+
+def find_duplicates(cols, new):
+    """Indices of new transactions sharing account, date, amount and counterparty with another"""
+    import numpy as np
+
+    if len(cols['keys']) == 0:
+        return np.array([], dtype=np.int64)
+    group_key = np.stack([cols['account'], cols['date'], cols['amount'], cols['counterparty']], axis=1)
+    _, inverse, counts = np.unique(group_key, axis=0, return_inverse=True, return_counts=True)
+    return np.flatnonzero(new & (counts[inverse.ravel()] > 1))
+
+
+def find_outliers(cols, new, counterparties):
+    """Indices and z-scores of new outflows far above the counterparty's usual payment"""
+    import numpy as np
+
+    names = cols['counterparty_names']
+    count = np.array([counterparties.get(n, {}).get('count', 0) for n in names], dtype=np.float64)
+    mean = np.array([counterparties.get(n, {}).get('mean', 0.0) for n in names], dtype=np.float64)
+    m2 = np.array([counterparties.get(n, {}).get('m2', 0.0) for n in names], dtype=np.float64)
+    std = np.sqrt(np.divide(m2, count - 1, out=np.zeros_like(m2), where=count > 1))
+    # Avoid flagging everything for counterparties that are always paid the same amount
+    std = np.maximum(std, 0.1 * mean, out=std)
+
+    spent = -cols['amount'].astype(np.float64)
+    cp = cols['counterparty']
+    candidates = new & (spent > 0) & (names[cp] != '') & (count[cp] >= MIN_COUNTERPARTY_HISTORY) & (std[cp] > 0)
+    z = np.zeros_like(spent)
+    z[candidates] = (spent[candidates] - mean[cp[candidates]]) / std[cp[candidates]]
+    flagged = np.flatnonzero(candidates & (z > OUTLIER_Z_SCORE))
+    return flagged, z
+
+
+def update_counterparty_stats(cols, new, counterparties):
+    """Merge the new outflows into the running per-counterparty statistics"""
+    import numpy as np
+
+    spent = -cols['amount'].astype(np.float64)
+    mask = new & (spent > 0) & (cols['counterparty_names'][cols['counterparty']] != '')
+    if not mask.any():
+        return
+
+    cp = cols['counterparty'][mask]
+    values = spent[mask]
+    size = len(cols['counterparty_names'])
+    batch_count = np.bincount(cp, minlength=size).astype(np.float64)
+    batch_sum = np.bincount(cp, weights=values, minlength=size)
+    batch_mean = np.divide(batch_sum, batch_count, out=np.zeros(size), where=batch_count > 0)
+    batch_m2 = np.bincount(cp, weights=(values - batch_mean[cp]) ** 2, minlength=size)
+
+    # Combine with the stored statistics (parallel variance algorithm)
+    for code in np.flatnonzero(batch_count):
+        name = cols['counterparty_names'][code]
+        stored = counterparties.get(name, {'count': 0, 'mean': 0.0, 'm2': 0.0})
+        n_a, n_b = stored['count'], batch_count[code]
+        n = n_a + n_b
+        delta = batch_mean[code] - stored['mean']
+        counterparties[name] = {
+            'count': int(n),
+            'mean': float(stored['mean'] + delta * n_b / n),
+            'm2': float(stored['m2'] + batch_m2[code] + delta ** 2 * n_a * n_b / n),
+        }
+
+
+def find_balance_drops(accounts_data, cols, new):
+    """(index, ratio) of the largest new outflow on days that took a large share of the balance"""
+    import numpy as np
+
+    drops = []
+    for account_index, account in enumerate(accounts_data):
+        end_balance = closing_balance(account)
+        in_account = np.flatnonzero(cols['account'] == account_index)
+        if end_balance is None or len(in_account) == 0:
+            continue
+
+        days, day_of_tx = np.unique(cols['date'][in_account], return_inverse=True)
+        amounts = cols['amount'][in_account]
+        net = np.bincount(day_of_tx, weights=amounts, minlength=len(days))
+        outflow = np.bincount(day_of_tx, weights=np.minimum(amounts, 0), minlength=len(days))
+
+        # Balance at the start of each day, walking back from the closing balance
+        after_and_including = np.cumsum(net[::-1])[::-1]
+        start_balance = end_balance - after_and_including
+
+        ratio = np.divide(-outflow, start_balance, out=np.zeros_like(outflow), where=start_balance > 0)
+        new_days = np.unique(day_of_tx[new[in_account]])
+        for day in new_days[ratio[new_days] > BALANCE_DROP_RATIO]:
+            # Report the day through its largest outflow
+            on_day = in_account[day_of_tx == day]
+            drops.append((int(on_day[np.argmin(cols['amount'][on_day])]), float(ratio[day])))
+    return drops
+
+
+def analyse_accounts(instance_path, user_id, accounts_data, today=None):
+    """Analyse the booked transactions of a user after a sync, return the new anomalies"""
+    import numpy as np
+
+    today = today or date.today()
+    with _state_lock:
+        state = load_state(instance_path, user_id)
+        processed = state['processed']
+        counterparties = state['counterparties']
+
+        cols = to_columns(accounts_data)
+        new = np.array([key not in processed for key in cols['keys']], dtype=bool)
+        if not new.any():
+            return []
+
+        anomalies = []
+        for i in find_duplicates(cols, new):
+            anomalies.append(_anomaly('duplicate', accounts_data, cols, i))
+
+        # Outliers are judged against the norm before this batch is merged in
+        flagged, z = find_outliers(cols, new, counterparties)
+        for i in flagged:
+            anomalies.append(_anomaly('outlier', accounts_data, cols, i, score=round(float(z[i]), 1)))
+        update_counterparty_stats(cols, new, counterparties)
+
+        for i, ratio in find_balance_drops(accounts_data, cols, new):
+            anomalies.append(_anomaly('balance_drop', accounts_data, cols, i, ratio=round(float(ratio), 2)))
+
+        detected_at = datetime.now().isoformat(timespec='seconds')
+        for anomaly in anomalies:
+            anomaly['detected_at'] = detected_at
+
+        # Remember what was processed, forgetting what the bank can't return anymore
+        for i in np.flatnonzero(new):
+            processed[cols['keys'][i]] = transaction_date(cols['transactions'][i])
+        cutoff = (today - timedelta(days=PROCESSED_RETENTION_DAYS)).isoformat()
+        state['processed'] = {key: d for key, d in processed.items() if d and d >= cutoff}
+
+        state['anomalies'] = (anomalies + state['anomalies'])[:MAX_ANOMALIES]
+        _save_state(instance_path, user_id, state)
+
+    return anomalies
@@ -0,0 +1,374 @@
+"""
+This module provides the public, read-only JSON API for transparency data.
+
+Every response carries a strong ETag derived from the version of the stored
+data, so clients can revalidate with If-None-Match and get a 304 without the
+data being loaded. Each client is limited by a token bucket, so heavy consumers
+can't starve the web UI.
+"""
+import os
+import json
+import time
+import base64
+import hashlib
+import threading
+from datetime import date
+from flask import Blueprint, jsonify, request, current_app, abort, url_for
+from app import db
+from app.archive import transaction_date, transaction_key, to_minor_units
+
+api_bp = Blueprint('api', __name__, url_prefix='/api/v1')
+
+MAX_PAGE_SIZE = 500
+
+
+class TokenBucketLimiter:
+    """Per-client token bucket: `rate` requests per second, bursts up to `burst`"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def consume(self, key):
+        """Take one token, return (allowed, remaining tokens, seconds until the next token)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.get(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+
+            # Forget clients whose bucket is full again, they are equivalent to new ones
+            if len(self._buckets) > 10000:
+                full_after = self.burst / self.rate
+                self._buckets = {k: v for k, v in self._buckets.items() if now - v[1] < full_after}
+
+        retry_after = 0 if allowed else (1 - tokens) / self.rate
+        return allowed, int(tokens), retry_after
+
+
+# Loaded organisation data, keyed by organisation ID, kept while its version is current
+_dataset_cache = {}
+_dataset_lock = threading.Lock()
+
+
+def _add_file_version(digest, path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return
+    digest.update(f'{path}:{stat.st_mtime_ns}:{stat.st_size};'.encode())
+
+
+def data_version(organisation):
+    """Version of an organisation's stored data, from the files it is read from"""
+    digest = hashlib.sha256()
+    for user_id in db.get_organisation_user_ids(organisation['id']):
+        for path in (os.path.join(current_app.instance_path, f'account_data_{user_id}.json'),
+                     os.path.join(current_app.instance_path, 'archive', str(user_id), 'index.json')):
+            _add_file_version(digest, path)
+    # Internal transfers change what the totals include
+    _add_file_version(digest, os.path.join(current_app.instance_path, f"internal_transfers_{organisation['id']}.json"))
+    return digest.hexdigest()[:32]
+
+
+def mask_iban(iban):
+    """Only publish the end of an IBAN"""
+    if not iban or len(iban) < 8:
+        return iban
+    return f'{iban[:4]}****{iban[-4:]}'
+
+
+def public_transaction(tx, account_id, status):
+    """The published fields of a transaction (counterparty IBANs and bank references are left out)"""
+    return {
+        'id': transaction_key(tx),
+        'account_id': account_id,
+        'status': status,
+        'date': transaction_date(tx),
+        'amount': tx.get('transactionAmount', {}).get('amount'),
+        'currency': tx.get('transactionAmount', {}).get('currency'),
+        'description': tx.get('remittanceInformationUnstructured') or tx.get('additionalInformation'),
+        'creditor_name': tx.get('creditorName'),
+        'debtor_name': tx.get('debtorName'),
+        'internal_transfer': bool(tx.get('internalTransfer')),
+    }
+
+
+def load_dataset(organisation, version):
+    """Accounts and transactions (newest first) of an organisation, cached per data version"""
+    with _dataset_lock:
+        cached = _dataset_cache.get(organisation['id'])
+    if cached and cached['version'] == version:
+        return cached
+
+    from app.routes import load_organisation_accounts
+
+    accounts = []
+    rows = []
+    for account in load_organisation_accounts(organisation):
+        accounts.append({
+            'id': account.get('id'),
+            'name': account.get('name', 'Unknown account'),
+            'iban': mask_iban(account.get('iban')),
+            'currency': account.get('currency', 'EUR'),
+            'balances': account.get('balances', []),
+        })
+        ordinal = 0
+        for category in ['booked', 'pending']:
+            for tx in account.get('transactions', {}).get(category, []):
+                tx_date = transaction_date(tx)
+                # IDs can repeat (across accounts, or identical fees without a
+                # bank ID): the position within the account makes the key unique
+                key = (tx_date or '', account.get('id') or '', transaction_key(tx), ordinal)
+                ordinal += 1
+                rows.append((key, public_transaction(tx, account.get('id'), category)))
+
+    # Total order for cursor pagination: newest first, ties broken by the rest of the key
+    rows.sort(key=lambda row: row[0], reverse=True)
+
+    dataset = {
+        'version': version,
+        'accounts': accounts,
+        'transactions': [tx for _, tx in rows],
+        'keys': [key for key, _ in rows],
+    }
+    with _dataset_lock:
+        _dataset_cache[organisation['id']] = dataset
+    return dataset
+
+
+def invalidate_dataset(organisation_id):
+    """Forget the loaded data of an organisation after a sync changed it"""
+    with _dataset_lock:
+        _dataset_cache.pop(organisation_id, None)
+
+
+def get_public_organisation(slug):
+    organisation = db.get_organisation_by_slug(slug)
+    if organisation is None or not organisation['is_public']:
+        abort(404)
+    return organisation
+
+
+def conditional_response(version, build):
+    """Answer 304 if the client has the current version, otherwise build the JSON response"""
+    # The representation depends on the data version and on the query
+    etag = hashlib.sha256(f'{version}?{request.query_string.decode()}'.encode()).hexdigest()[:32]
+    # Compressed responses carry the encoding as an ETag suffix (see app/compression.py),
+    # a 304 echoes the variant the client has
+    matched = next((tag for tag in (etag, f'{etag}-gzip', f'{etag}-br') if request.if_none_match.contains(tag)), None)
+    if matched:
+        response = current_app.response_class(status=304)
+        response.set_etag(matched)
+    else:
+        response = jsonify(build())
+        response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.no_cache = True  # Always revalidate, 304s are cheap
+    return response
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(list(key)).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        tx_date, account_id, tx_id, ordinal = json.loads(base64.urlsafe_b64decode(padded))
+        return str(tx_date), str(account_id), str(tx_id), int(ordinal)
+    except (ValueError, TypeError):
+        abort(400, description='Invalid cursor')
+
+
+def parse_date_arg(name):
+    value = request.args.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value).isoformat()
+    except ValueError:
+        abort(400, description=f'Invalid date for {name}, expected YYYY-MM-DD')
+
+
+@api_bp.before_request
+def rate_limit():
+    """Reject clients that exhausted their token bucket"""
+    limiter = current_app.extensions['api_rate_limiter']
+    allowed, remaining, retry_after = limiter.consume(request.remote_addr or 'unknown')
+    request.rate_limit_remaining = remaining
+    if not allowed:
+        response = jsonify({'error': 'Too many requests'})
+        response.status_code = 429
+        response.headers['Retry-After'] = str(max(1, int(retry_after + 0.999)))
+        return response
+
+
+@api_bp.after_request
+def add_rate_limit_headers(response):
+    response.headers['X-RateLimit-Limit'] = str(current_app.config['API_RATE_BURST'])
+    response.headers['X-RateLimit-Remaining'] = str(getattr(request, 'rate_limit_remaining', 0))
+    return response
+
+
+@api_bp.errorhandler(400)
+@api_bp.errorhandler(404)
+def api_error(error):
+    response = jsonify({'error': error.description})
+    response.status_code = error.code
+    return response
+
+
+@api_bp.route('/organisations')
+def list_organisations():
+    """Public organisations"""
+    organisations = [(o['slug'], o['name']) for o in db.get_public_organisations()]
+    version = hashlib.sha256(json.dumps(organisations).encode()).hexdigest()[:32]
+    return conditional_response(version, lambda: {'organisations': [
+        {'slug': slug, 'name': name, 'url': url_for('api.organisation_accounts', slug=slug)}
+        for slug, name in organisations
+    ]})
+
+
+@api_bp.route('/organisations/<slug>/accounts')
+def organisation_accounts(slug):
+    """Accounts of an organisation with their balances"""
+    organisation = get_public_organisation(slug)
+    version = data_version(organisation)
+    return conditional_response(version, lambda: {
+        'version': version,
+        'accounts': load_dataset(organisation, version)['accounts'],
+    })
+
+
+@api_bp.route('/organisations/<slug>/balances')
+def organisation_balances(slug):
+    """Current balance of each account and the total per currency"""
+    organisation = get_public_organisation(slug)
+    version = data_version(organisation)
+
+    def build():
+        balances = []
+        totals = {}
+        for account in load_dataset(organisation, version)['accounts']:
+            # Same balance as the transparency page: the first one reported
+            balance = (account['balances'] or [{}])[0].get('balanceAmount', {})
+            amount = balance.get('amount', '0')
+            currency = balance.get('currency', account['currency'])
+            balances.append({'account_id': account['id'], 'amount': amount, 'currency': currency})
+            totals[currency] = totals.get(currency, 0) + to_minor_units(amount)
+        return {
+            'version': version,
+            'balances': balances,
+            'totals': {currency: f'{cents / 100:.2f}' for currency, cents in totals.items()},
+        }
+
+    return conditional_response(version, build)
+
+
+@api_bp.route('/organisations/<slug>/transactions')
+def organisation_transactions(slug):
+    """
+    Transactions, newest first, with cursor pagination.
+
+    Query parameters: limit, cursor (from the previous page), account, status,
+    from and to (YYYY-MM-DD, inclusive).
+    """
+    organisation = get_public_organisation(slug)
+    version = data_version(organisation)
+
+    try:
+        limit = min(MAX_PAGE_SIZE, max(1, int(request.args.get('limit', 100))))
+    except ValueError:
+        abort(400, description='Invalid limit')
+    cursor = decode_cursor(request.args['cursor']) if request.args.get('cursor') else None
+    account_id = request.args.get('account')
+    status = request.args.get('status')
+    date_from = parse_date_arg('from')
+    date_to = parse_date_arg('to')
+
+    def build():
+        dataset = load_dataset(organisation, version)
+        page = []
+        last_key = None
+        has_more = False
+        for key, tx in zip(dataset['keys'], dataset['transactions']):
+            if cursor and key >= cursor:
+                continue
+            if account_id and tx['account_id'] != account_id:
+                continue
+            if status and tx['status'] != status:
+                continue
+            if date_to and (tx['date'] or '') > date_to:
+                continue
+            if date_from and (tx['date'] or '') < date_from:
+                # Sorted newest first: nothing older can match
+                break
+            if len(page) == limit:
+                has_more = True
+                break
+            page.append(tx)
+            last_key = key
+
+        return {
+            'version': version,
+            'transactions': page,
+            'next_cursor': encode_cursor(last_key) if has_more else None,
+        }
+
+    return conditional_response(version, build)
+
+
+@api_bp.route('/organisations/<slug>/aggregates')
+def organisation_aggregates(slug):
+    """Booked income and expenses per month (query parameters: account, from, to)"""
+    organisation = get_public_organisation(slug)
+    version = data_version(organisation)
+    account_id = request.args.get('account')
+    date_from = parse_date_arg('from')
+    date_to = parse_date_arg('to')
+
+    def build():
+        from app.routes import load_organisation_sums
+
+        # Closed months come from the archive's per-partition sums, only the hot
+        # store is scanned, and only for accounts still in the hot store (the
+        # archive of a deleted account is not counted). Across accounts,
+        # transfers between them would count as both income and expense
+        months = load_organisation_sums(
+            organisation, account_id=account_id,
+            start=date.fromisoformat(date_from) if date_from else None,
+            end=date.fromisoformat(date_to) if date_to else None,
+            exclude_internal=not account_id,
+        )
+
+        return {
+            'version': version,
+            'months': [
+                {
+                    'month': month,
+                    'currency': currency,
+                    'count': values['count'],
+                    'income': f"{values['income'] / 100:.2f}",
+                    'expenses': f"{values['expenses'] / 100:.2f}",
+                    'net': f"{(values['income'] + values['expenses']) / 100:.2f}",
+                }
+                for (month, currency), values in sorted(months.items(), reverse=True)
+            ],
+        }
+
+    return conditional_response(version, build)
+
+
+def init_app(app):
+    app.config.setdefault('API_RATE_LIMIT', 5.0)
+    app.config.setdefault('API_RATE_BURST', 30)
+    app.extensions['api_rate_limiter'] = TokenBucketLimiter(
+        app.config['API_RATE_LIMIT'], app.config['API_RATE_BURST']
+    )
+    app.register_blueprint(api_bp)
@@ -0,0 +1,388 @@
+"""
+This module handles the archive tier for historical transactions.
+
+Booked transactions of closed months are rolled out of the hot store
+(account_data_<user_id>.json) into immutable partitions, one per account
+per month, stored under instance/archive/<user_id>/.
+
+Each partition file is laid out as:
+    header   magic, number of rows, payload length
+    dates    int32 column, days since 0001-01-01, sorted ascending
+    amounts  int64 column, amounts in minor units (cents)
+    payload  zlib-compressed JSON list of the full transaction records
+
+The numeric columns are read through a memory map, so range queries and
+aggregates never decompress or parse the transaction records; the index
+also keeps the sums of each partition, so aggregates over whole months
+don't open the files at all. Decoded records are cached while the
+partition file is unchanged.
+"""
+import os
+import json
+import mmap
+import zlib
+import struct
+import bisect
+import hashlib
+import threading
+from array import array
+from collections import OrderedDict
+from datetime import date
+from decimal import Decimal, ROUND_HALF_UP, InvalidOperation
+
+MAGIC = b'BTARCH01'
+HEADER = struct.Struct('<8sIIQ')  # magic, rows, reserved, payload length
+
+# Serializes index updates between the scheduler and request threads
+_index_lock = threading.Lock()
+
+# Decoded partitions, keyed by (path, mtime, size), least recently used first
+MAX_CACHED_PARTITIONS = 256
+_records_cache = OrderedDict()
+_records_lock = threading.Lock()
+
+
+def archive_dir(instance_path, user_id):
+    """Directory holding the archive of a user"""
+    return os.path.join(instance_path, 'archive', str(user_id))
+
+
+def _index_path(instance_path, user_id):
+    return os.path.join(archive_dir(instance_path, user_id), 'index.json')
+
+
+def load_index(instance_path, user_id):
+    """Get the partition index of a user"""
+    index_path = _index_path(instance_path, user_id)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass
+    return {'version': 1, 'partitions': []}
+
+
+def _save_index(instance_path, user_id, index):
+    index_path = _index_path(instance_path, user_id)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def transaction_date(tx):
+    """Get the booking date of a transaction as a string, or None"""
+    return tx.get('bookingDate') or tx.get('valueDate')
+
+
+def to_minor_units(amount):
+    """Convert an API amount ("-12.30") to an integer number of cents"""
+    try:
+        value = Decimal(str(amount))
+    except InvalidOperation:
+        return 0
+    return int((value * 100).to_integral_value(rounding=ROUND_HALF_UP))
+
+
+def transaction_key(tx):
+    """Stable identity of a transaction, used to detect already archived rows"""
+    if tx.get('transactionId'):
+        return tx['transactionId']
+    return '|'.join([
+        transaction_date(tx) or '',
+        str(tx.get('transactionAmount', {}).get('amount', '')),
+        tx.get('remittanceInformationUnstructured') or '',
+    ])
+
+
+def _partition_file_name(account_id, month):
+    # Account IDs are UUIDs from the API, but keep the path safe anyway
+    safe_id = ''.join(c for c in str(account_id) if c.isalnum() or c in '-_')
+    return os.path.join(safe_id, f'{month}.part')
+
+
+def write_partition(path, transactions):
+    """Write an immutable partition file and return its index metadata"""
+    rows = sorted(transactions, key=lambda tx: transaction_date(tx))
+
+    dates = array('i', (date.fromisoformat(transaction_date(tx)).toordinal() for tx in rows))
+    amounts = array('q', (to_minor_units(tx.get('transactionAmount', {}).get('amount', 0)) for tx in rows))
+    payload = zlib.compress(json.dumps(rows, separators=(',', ':')).encode('utf-8'), 9)
+
+    # Pad the int32 column so the int64 column starts on an 8-byte boundary
+    dates_bytes = dates.tobytes()
+    padding = b'\0' * (-len(dates_bytes) % 8)
+
+    content = b''.join([
+        HEADER.pack(MAGIC, len(rows), 0, len(payload)),
+        dates_bytes,
+        padding,
+        amounts.tobytes(),
+        payload,
+    ])
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
+
+    return {
+        'rows': len(rows),
+        'first_date': transaction_date(rows[0]) if rows else None,
+        'last_date': transaction_date(rows[-1]) if rows else None,
+        'total_cents': sum(amounts),
+        'inflow_cents': sum(a for a in amounts if a > 0),
+        'outflow_cents': sum(a for a in amounts if a < 0),
+        'sha256': hashlib.sha256(content).hexdigest(),
+    }
+
+
+class Partition:
+    """Read-only, memory-mapped view of a partition file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        try:
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:
+            # Empty files cannot be mapped
+            self._file.close()
+            raise ValueError(f"Empty archive partition: {path}")
+
+        magic, self.rows, _, payload_length = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError(f"Not an archive partition: {path}")
+
+        view = memoryview(self._map)
+        offset = HEADER.size
+        self.dates = view[offset:offset + 4 * self.rows].cast('i')
+        offset += 4 * self.rows
+        offset += -offset % 8
+        self.amounts = view[offset:offset + 8 * self.rows].cast('q')
+        offset += 8 * self.rows
+        self._payload = view[offset:offset + payload_length]
+
+    def bounds(self, start=None, end=None):
+        """Row range [lo, hi) of transactions between two dates (inclusive)"""
+        lo = bisect.bisect_left(self.dates, start.toordinal()) if start else 0
+        hi = bisect.bisect_right(self.dates, end.toordinal()) if end else self.rows
+        return lo, hi
+
+    def records(self, lo=0, hi=None):
+        """Decompress the full transaction records of a row range"""
+        rows = json.loads(zlib.decompress(self._payload))
+        return rows[lo:hi]
+
+    def close(self):
+        # Views on the map must be released before the map can be closed
+        for name in ('dates', 'amounts', '_payload'):
+            view = self.__dict__.pop(name, None)
+            if view is not None:
+                view.release()
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _matching_partitions(instance_path, user_id, account_id=None, start=None, end=None):
+    """Index entries that may contain transactions in the requested range"""
+    index = load_index(instance_path, user_id)
+    start_str = start.isoformat() if start else None
+    end_str = end.isoformat() if end else None
+
+    for entry in index['partitions']:
+        if account_id is not None and entry['account_id'] != account_id:
+            continue
+        if start_str and entry['last_date'] and entry['last_date'] < start_str:
+            continue
+        if end_str and entry['first_date'] and entry['first_date'] > end_str:
+            continue
+        yield entry
+
+
+def _covers(entry, start, end):
+    """Whether an index entry lies entirely inside the requested range"""
+    return ((start is None or entry['first_date'] >= start.isoformat())
+            and (end is None or entry['last_date'] <= end.isoformat()))
+
+
+def _cached_partition(path):
+    """Dates column and decoded records of a partition, cached while the file is unchanged"""
+    stat = os.stat(path)
+    key = (path, stat.st_mtime_ns, stat.st_size)
+    with _records_lock:
+        cached = _records_cache.get(key)
+        if cached is not None:
+            _records_cache.move_to_end(key)
+            return cached
+
+    with Partition(path) as part:
+        cached = (part.dates.tolist(), part.records())
+
+    with _records_lock:
+        _records_cache[key] = cached
+        while len(_records_cache) > MAX_CACHED_PARTITIONS:
+            _records_cache.popitem(last=False)
+    return cached
+
+
+def load_transactions(instance_path, user_id, account_id=None, start=None, end=None):
+    """Get archived transaction records, optionally filtered by account and date range"""
+    base = archive_dir(instance_path, user_id)
+    transactions = []
+    for entry in _matching_partitions(instance_path, user_id, account_id, start, end):
+        dates, rows = _cached_partition(os.path.join(base, entry['file']))
+        lo = bisect.bisect_left(dates, start.toordinal()) if start else 0
+        hi = bisect.bisect_right(dates, end.toordinal()) if end else len(dates)
+        for tx in rows[lo:hi]:
+            # Copies, callers annotate the records they get
+            tx = dict(tx)
+            tx['account_id'] = entry['account_id']
+            transactions.append(tx)
+    return transactions
+
+
+def _partition_sums(base, entry, start, end):
+    """Count, inflow and outflow (cents) of a partition's transactions in range"""
+    if _covers(entry, start, end):
+        # The whole partition is in range, the index already has the sums
+        return entry['rows'], entry['inflow_cents'], entry['outflow_cents']
+
+    count = inflow = outflow = 0
+    with Partition(os.path.join(base, entry['file'])) as part:
+        lo, hi = part.bounds(start, end)
+        for amount in part.amounts[lo:hi]:
+            count += 1
+            if amount > 0:
+                inflow += amount
+            else:
+                outflow += amount
+    return count, inflow, outflow
+
+
+def aggregate(instance_path, user_id, account_id=None, start=None, end=None):
+    """Count and sum archived transactions without decompressing any records"""
+    base = archive_dir(instance_path, user_id)
+    result = {'count': 0, 'total_cents': 0, 'inflow_cents': 0, 'outflow_cents': 0}
+
+    for entry in _matching_partitions(instance_path, user_id, account_id, start, end):
+        count, inflow, outflow = _partition_sums(base, entry, start, end)
+        result['count'] += count
+        result['total_cents'] += inflow + outflow
+        result['inflow_cents'] += inflow
+        result['outflow_cents'] += outflow
+
+    return result
+
+
+def monthly_sums(instance_path, user_id, account_id=None, start=None, end=None):
+    """Like aggregate(), per (account ID, month, currency) of the archived partitions"""
+    base = archive_dir(instance_path, user_id)
+    result = {}
+    for entry in _matching_partitions(instance_path, user_id, account_id, start, end):
+        count, inflow, outflow = _partition_sums(base, entry, start, end)
+        if count:
+            result[(entry['account_id'], entry['month'], entry.get('currency', 'EUR'))] = {
+                'count': count, 'inflow_cents': inflow, 'outflow_cents': outflow,
+            }
+    return result
+
+
+def archive_closed_months(instance_path, user_id, accounts_data, today=None):
+    """
+    Roll booked transactions of closed months into archive partitions.
+
+    Returns a copy of the accounts data with archived transactions removed,
+    ready to be written to the hot store. Partitions are immutable: transactions
+    arriving late for an already archived month stay in the hot store, where
+    later syncs keep them (see app.sync.keep_stored_transactions).
+    """
+    current_month = (today or date.today()).strftime('%Y-%m')
+    base = archive_dir(instance_path, user_id)
+
+    with _index_lock:
+        index = load_index(instance_path, user_id)
+        archived = {(e['account_id'], e['month']): e for e in index['partitions']}
+        changed = False
+        hot_accounts = []
+
+        for account in accounts_data:
+            account_id = account.get('id')
+            booked = account.get('transactions', {}).get('booked')
+            if not account_id or not booked:
+                hot_accounts.append(account)
+                continue
+
+            # Group closed-month transactions by month
+            by_month = {}
+            hot = []
+            for tx in booked:
+                tx_date = transaction_date(tx)
+                if tx_date and tx_date[:7] < current_month:
+                    by_month.setdefault(tx_date[:7], []).append(tx)
+                else:
+                    hot.append(tx)
+
+            for month, transactions in by_month.items():
+                entry = archived.get((account_id, month))
+                if entry is None:
+                    file_name = _partition_file_name(account_id, month)
+                    entry = write_partition(os.path.join(base, file_name), transactions)
+                    entry.update({
+                        'account_id': account_id,
+                        'month': month,
+                        'file': file_name,
+                        'currency': account.get('currency', 'EUR'),
+                    })
+                    index['partitions'].append(entry)
+                    archived[(account_id, month)] = entry
+                    changed = True
+                    continue
+
+                # Already archived: keep only rows the partition does not know
+                _, rows = _cached_partition(os.path.join(base, entry['file']))
+                known = {transaction_key(tx) for tx in rows}
+                hot.extend(tx for tx in transactions if transaction_key(tx) not in known)
+
+            # Keep the hot store in the same order as the API returned it
+            hot_keys = {id(tx) for tx in hot}
+            hot_account = dict(account)
+            hot_account['transactions'] = dict(account['transactions'])
+            hot_account['transactions']['booked'] = [tx for tx in booked if id(tx) in hot_keys]
+            hot_accounts.append(hot_account)
+
+        if changed:
+            index['partitions'].sort(key=lambda e: (e['account_id'], e['month']))
+            _save_index(instance_path, user_id, index)
+
+    return hot_accounts
+
+
+def remove_account(instance_path, user_id, account_id):
+    """Delete every partition of an account, return the number of bytes freed"""
+    base = archive_dir(instance_path, user_id)
+    freed = 0
+    with _index_lock:
+        index = load_index(instance_path, user_id)
+        kept = []
+        for entry in index['partitions']:
+            if entry['account_id'] != account_id:
+                kept.append(entry)
+                continue
+            path = os.path.join(base, entry['file'])
+            if os.path.exists(path):
+                freed += os.path.getsize(path)
+                os.remove(path)
+        if len(kept) != len(index['partitions']):
+            index['partitions'] = kept
+            _save_index(instance_path, user_id, index)
+    return freed
@@ -3,29 +3,56 @@ from flask_wtf import FlaskForm
 from wtforms import StringField, PasswordField, SubmitField
 from wtforms.validators import DataRequired
 from flask_login import login_user, logout_user, login_required, UserMixin, current_user
-from werkzeug.security import check_password_hash, generate_password_hash
+from werkzeug.security import check_password_hash
 from app import login_manager
+from app import db
 from flask_babel import lazy_gettext as _l
-import os
+import threading
+import time
 
 # Authentication blueprint
 auth = Blueprint('auth', __name__)
 
 # Simple user model for Flask-Login
 class User(UserMixin):
-    def __init__(self, id, username, password_hash):
+    def __init__(self, id, username, password_hash, organisation_id=None, is_admin=False):
         self.id = id
         self.username = username
         self.password_hash = password_hash
+        self.organisation_id = organisation_id
+        self.is_admin = is_admin
 
-# Demo user (to be replaced with a database)
-users = {
-    1: User(1, 'admin', generate_password_hash(os.environ.get('ADMIN_PASSWORD', 'password')))
-}
+    @classmethod
+    def from_row(cls, row):
+        return cls(row['id'], row['username'], row['password_hash'],
+                   row['organisation_id'], bool(row['is_admin']))
+
+# The user loader runs on every request, so keep loaded users for a short while
+# instead of querying the database each time
+_user_cache = {}
+_user_cache_lock = threading.Lock()
+
+def clear_user_cache():
+    """Forget cached users (call after changing users in the database)"""
+    with _user_cache_lock:
+        _user_cache.clear()
 
 @login_manager.user_loader
 def load_user(user_id):
-    return users.get(int(user_id))
+    user_id = int(user_id)
+    now = time.monotonic()
+
+    with _user_cache_lock:
+        cached = _user_cache.get(user_id)
+    if cached and cached[0] > now:
+        return cached[1]
+
+    row = db.get_user_row(user_id)
+    user = User.from_row(row) if row else None
+
+    with _user_cache_lock:
+        _user_cache[user_id] = (now + current_app.config['USER_CACHE_TTL'], user)
+    return user
 
 # Login form
 class LoginForm(FlaskForm):
@@ -43,8 +70,9 @@ def login():
     if form.validate_on_submit():
         username = form.username.data
         
-        # Search for the user by username
-        user = next((u for u in users.values() if u.username == username), None)
+        # Search for the user by username (indexed lookup)
+        row = db.get_user_row_by_username(username)
+        user = User.from_row(row) if row else None
         
         if user and check_password_hash(user.password_hash, form.password.data):
             login_user(user, remember=True)
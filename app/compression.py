@@ -0,0 +1,186 @@
+"""
+This module handles HTTP response compression and caching of static assets.
+"""
+import os
+import gzip
+import hashlib
+import threading
+from collections import OrderedDict
+from flask import request, url_for, current_app
+
+# Brotli is optional, gzip from the standard library is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Mimetypes worth compressing (images and fonts are already compressed)
+COMPRESSIBLE_MIMETYPES = {
+    'text/html',
+    'text/css',
+    'text/plain',
+    'text/javascript',
+    'application/javascript',
+    'application/json',
+    'image/svg+xml',
+}
+
+# One year, the usual value for immutable assets
+STATIC_MAX_AGE = 31536000
+
+
+class CompressedVariantCache:
+    """Small thread-safe LRU cache of precompressed response bodies"""
+
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            variants = self._entries.get(key)
+            if variants is not None:
+                self._entries.move_to_end(key)
+            return variants
+
+    def set(self, key, variants):
+        with self._lock:
+            self._entries[key] = variants
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Precompressed variants of snapshot pages, keyed by the hash of their body
+variant_cache = CompressedVariantCache()
+
+# Content hashes of static files, keyed by (path, mtime)
+_static_hashes = {}
+
+
+def compress_body(data, encoding, level):
+    """Compress a response body with the given content encoding"""
+    if encoding == 'br':
+        # Brotli quality goes from 0 to 11, map the gzip level onto it
+        return brotli.compress(data, quality=min(11, level + 2))
+    # mtime=0 keeps the output deterministic for identical bodies
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def available_encodings():
+    """Content encodings supported by this process, preferred first"""
+    return ['br', 'gzip'] if brotli is not None else ['gzip']
+
+
+def choose_encoding(accept_encoding):
+    """Pick the best content encoding accepted by the client"""
+    for encoding in available_encodings():
+        if accept_encoding[encoding] > 0:
+            return encoding
+    return None
+
+
+def static_url(filename):
+    """Build a content-hashed URL for a file in the static folder"""
+    static_folder = current_app.static_folder
+    file_path = os.path.join(static_folder, filename)
+    try:
+        mtime = os.path.getmtime(file_path)
+    except OSError:
+        # Unknown file, let Flask build a plain URL (it will 404 anyway)
+        return url_for('static', filename=filename)
+
+    key = (file_path, mtime)
+    digest = _static_hashes.get(key)
+    if digest is None:
+        with open(file_path, 'rb') as f:
+            digest = hashlib.sha256(f.read()).hexdigest()[:12]
+        _static_hashes[key] = digest
+
+    return url_for('static', filename=filename, v=digest)
+
+
+def add_static_cache_headers(response):
+    """Mark content-hashed static files as cacheable forever"""
+    if request.endpoint == 'static' and request.args.get('v') and response.status_code in (200, 304):
+        response.cache_control.no_cache = None
+        response.cache_control.public = True
+        response.cache_control.max_age = current_app.config['STATIC_MAX_AGE']
+        response.cache_control.immutable = True
+    return response
+
+
+def compress_response(response):
+    """Compress the response body if the client supports it and it is big enough"""
+    config = current_app.config
+    if not config['COMPRESS_ENABLED']:
+        return response
+
+    # Only compress complete, successful responses of a compressible type
+    if response.status_code != 200 or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+    if response.is_streamed and request.endpoint != 'static':
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    encoding = choose_encoding(request.accept_encodings)
+    if encoding is None:
+        return response
+
+    # Static files are sent as a file wrapper, read them so they can be compressed
+    if response.direct_passthrough:
+        response.direct_passthrough = False
+
+    data = response.get_data()
+    if len(data) < config['COMPRESS_MIN_SIZE']:
+        return response
+
+    level = config['COMPRESS_LEVEL']
+    if request.endpoint in config['COMPRESS_SNAPSHOT_ENDPOINTS']:
+        # Snapshot pages only change after a sync, so compress every variant once
+        # and serve the same bytes until the content changes
+        digest = hashlib.sha256(data).hexdigest()
+        variants = variant_cache.get(digest)
+        if variants is None:
+            variants = {enc: compress_body(data, enc, level) for enc in available_encodings()}
+            variant_cache.set(digest, variants)
+        compressed = variants[encoding]
+        response.set_etag(f"{digest[:32]}-{encoding}")
+    else:
+        compressed = compress_body(data, encoding, level)
+        # The compressed representation must not share the identity ETag
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f"{etag}-{encoding}", weak)
+
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+    response.headers['Content-Length'] = str(len(compressed))
+
+    if response.get_etag()[0]:
+        response.make_conditional(request)
+
+    return response
+
+
+def init_app(app):
+    """Register compression and static caching on the application"""
+    app.config.setdefault('COMPRESS_ENABLED', True)
+    app.config.setdefault('COMPRESS_MIN_SIZE', 500)
+    app.config.setdefault('COMPRESS_LEVEL', 6)
+    app.config.setdefault('COMPRESS_SNAPSHOT_ENDPOINTS', {'main.transparency'})
+    app.config.setdefault('STATIC_MAX_AGE', STATIC_MAX_AGE)
+
+    variant_cache.max_entries = app.config.get('COMPRESS_CACHE_SIZE', variant_cache.max_entries)
+
+    app.after_request(add_static_cache_headers)
+    app.after_request(compress_response)
+    app.add_template_global(static_url)
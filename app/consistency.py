@@ -0,0 +1,282 @@
+"""
+This module checks that the stored transaction history adds up to the balances
+reported by the bank, and schedules refetches of the date ranges that don't.
+
+For each account, booked transactions are put in chronological order and their
+running sum is compared with:
+    running_balance  the balanceAfterTransaction of consecutive transactions
+    closing          the closingBooked balance of the account
+    between_syncs    the closingBooked balance seen at the previous sync
+
+A mismatch means transactions are missing (or duplicated) in a date window;
+only that window is fetched again, as a one-off job of the background scheduler.
+State is kept in instance/consistency_<user_id>.json.
+"""
+import os
+import json
+import threading
+from datetime import date, datetime, timedelta
+from app.archive import transaction_date, transaction_key, to_minor_units
+from app.archive import load_transactions as load_archived_transactions
+
+# Refetches of the same window before giving up on it
+MAX_REFETCH_ATTEMPTS = 3
+# Seconds between detecting an inconsistency and refetching the window
+REFETCH_DELAY = 60
+
+_state_lock = threading.Lock()
+
+
+def _state_path(instance_path, user_id):
+    return os.path.join(instance_path, f'consistency_{user_id}.json')
+
+
+def load_state(instance_path, user_id):
+    """Get the consistency state (verified balances, open issues) of a user"""
+    state_path = _state_path(instance_path, user_id)
+    if os.path.exists(state_path):
+        try:
+            with open(state_path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass
+    return {'accounts': {}, 'issues': []}
+
+
+def get_issues(instance_path, user_id):
+    """Date windows whose transactions don't add up to the reported balances"""
+    return load_state(instance_path, user_id)['issues']
+
+
+def _save_state(instance_path, user_id, state):
+    state_path = _state_path(instance_path, user_id)
+    tmp_path = state_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, state_path)
+
+
+def balance_after(tx):
+    """balanceAfterTransaction of a transaction in cents, or None"""
+    amount = (tx.get('balanceAfterTransaction') or {}).get('balanceAmount', {}).get('amount')
+    return to_minor_units(amount) if amount is not None else None
+
+
+def closing_booked(account, today):
+    """(cents, reference date) of the closingBooked balance, or None"""
+    for balance in account.get('balances', []):
+        if balance.get('balanceType') == 'closingBooked':
+            reference_date = balance.get('referenceDate') or today.isoformat()
+            return to_minor_units(balance.get('balanceAmount', {}).get('amount', 0)), reference_date
+    return None
+
+
+def _issue(account_id, kind, date_from, date_to, difference):
+    return {
+        'account_id': account_id,
+        'kind': kind,
+        'date_from': date.fromordinal(int(date_from)).isoformat(),
+        'date_to': date.fromordinal(int(date_to)).isoformat(),
+        'difference': f'{difference / 100:.2f}',
+    }
+
+
+def check_account(account, previous=None, today=None, instance_path=None, user_id=None):
+    """
+    Check one account, return (issues, closing balance to remember or None).
+
+    `previous` is the closing balance verified at an earlier sync. It is only
+    replaced once the transactions in between account for the difference.
+    """
+    import numpy as np
+
+    today = today or date.today()
+    account_id = account.get('id')
+    # The API lists the newest transactions first
+    booked = [tx for tx in reversed(account.get('transactions', {}).get('booked', [])) if transaction_date(tx)]
+
+    dates = np.array([date.fromisoformat(transaction_date(tx)).toordinal() for tx in booked], dtype=np.int64)
+    amounts = np.array([to_minor_units(tx.get('transactionAmount', {}).get('amount', 0)) for tx in booked],
+                       dtype=np.int64)
+    balances = [balance_after(tx) for tx in booked]
+    has_balance = np.array([b is not None for b in balances], dtype=bool)
+    after = np.array([b or 0 for b in balances], dtype=np.int64)
+
+    # Chronological order, keeping the API order within a day
+    order = np.argsort(dates, kind='stable')
+    dates, amounts, has_balance, after = dates[order], amounts[order], has_balance[order], after[order]
+    running = np.cumsum(amounts)
+
+    issues = []
+
+    # Every transaction with a balance implies the same opening balance, unless
+    # something is missing between two of them
+    anchors = np.flatnonzero(has_balance)
+    opening = after[anchors] - running[anchors]
+    for k in np.flatnonzero(np.diff(opening)):
+        issues.append(_issue(account_id, 'running_balance', dates[anchors[k]], dates[anchors[k + 1]],
+                             opening[k + 1] - opening[k]))
+
+    closing = closing_booked(account, today)
+    if closing is None:
+        return issues, None
+    closing_cents, reference_date = closing
+    reference = date.fromisoformat(reference_date).toordinal()
+
+    # The last balance we know must lead to the closing balance
+    last = np.searchsorted(dates, reference, side='right') - 1
+    usable = anchors[anchors <= last] if last >= 0 else anchors[:0]
+    if len(usable):
+        anchor = usable[-1]
+        expected = after[anchor] + running[last] - running[anchor]
+        if expected != closing_cents:
+            issues.append(_issue(account_id, 'closing', dates[anchor], reference, closing_cents - expected))
+
+    # Since the previous sync, the balance moved by the transactions in between
+    verified = {'closing': int(closing_cents), 'reference_date': reference_date}
+    if previous and previous['reference_date'] < reference_date:
+        since = date.fromisoformat(previous['reference_date']).toordinal() + 1
+        in_window = (dates >= since) & (dates <= reference)
+        flows = int(amounts[in_window].sum())
+
+        # Part of the window may already have been rolled into the archive
+        if instance_path is not None:
+            known = {transaction_key(tx) for tx in booked}
+            for tx in load_archived_transactions(instance_path, user_id, account_id=account_id,
+                                                 start=date.fromordinal(since), end=date.fromordinal(reference)):
+                if transaction_key(tx) not in known:
+                    flows += to_minor_units(tx.get('transactionAmount', {}).get('amount', 0))
+
+        difference = closing_cents - previous['closing'] - flows
+        if difference:
+            issues.append(_issue(account_id, 'between_syncs', since, reference, difference))
+            verified = None
+
+    return issues, verified
+
+
+def merge_windows(issues):
+    """Merge overlapping or adjacent windows of the same account into one"""
+    merged = []
+    for issue in sorted(issues, key=lambda i: (i['account_id'], i['date_from'])):
+        last = merged[-1] if merged else None
+        if (last and last['account_id'] == issue['account_id'] and
+                date.fromisoformat(issue['date_from']) <= date.fromisoformat(last['date_to']) + timedelta(days=1)):
+            last['date_to'] = max(last['date_to'], issue['date_to'])
+            last['kinds'] = sorted(set(last['kinds']) | {issue['kind']})
+            # Overlapping windows measure the same gap: keep the largest, don't add them up
+            if abs(float(issue['difference'])) > abs(float(last['difference'])):
+                last['difference'] = issue['difference']
+        else:
+            merged.append({
+                'account_id': issue['account_id'],
+                'kinds': [issue['kind']],
+                'date_from': issue['date_from'],
+                'date_to': issue['date_to'],
+                'difference': issue['difference'],
+            })
+    return merged
+
+
+def _issue_key(issue):
+    return issue['account_id'], issue['date_from'], issue['date_to']
+
+
+def check_accounts(instance_path, user_id, accounts_data, today=None):
+    """Check the accounts of a user after a sync, return the windows that need a refetch"""
+    today = today or date.today()
+    with _state_lock:
+        state = load_state(instance_path, user_id)
+        previous_issues = {_issue_key(i): i for i in state['issues']}
+
+        found = []
+        checked_accounts = set()
+        for account in accounts_data:
+            account_id = account.get('id')
+            if not account_id:
+                continue
+            checked_accounts.add(account_id)
+            previous = state['accounts'].get(account_id)
+            issues, verified = check_account(account, previous, today, instance_path, user_id)
+            found.extend(issues)
+
+            if verified is not None:
+                state['accounts'][account_id] = verified
+
+        issues = []
+        for issue in merge_windows(found):
+            known = previous_issues.get(_issue_key(issue), {})
+            issue['attempts'] = known.get('attempts', 0)
+            issue['status'] = known.get('status', 'pending')
+            issue['detected_at'] = known.get('detected_at', datetime.now().isoformat(timespec='seconds'))
+            if issue['attempts'] >= MAX_REFETCH_ATTEMPTS and issue['status'] != 'scheduled':
+                issue['status'] = 'unresolved'
+            issues.append(issue)
+
+            # Give up on a between-syncs gap after the last refetch, so the
+            # following syncs are checked against the current balance
+            if issue['status'] == 'unresolved' and 'between_syncs' in issue['kinds']:
+                account = next(a for a in accounts_data if a.get('id') == issue['account_id'])
+                closing = closing_booked(account, today)
+                if closing:
+                    state['accounts'][issue['account_id']] = {'closing': closing[0], 'reference_date': closing[1]}
+
+        # Issues of accounts that were not part of this sync are kept as they are
+        issues.extend(i for i in state['issues'] if i['account_id'] not in checked_accounts)
+        state['issues'] = issues
+        _save_state(instance_path, user_id, state)
+
+    return [i for i in issues if i['status'] == 'pending']
+
+
+def schedule_refetches(app, user_id):
+    """Refetch the inconsistent windows of a user in one-off scheduler jobs"""
+    scheduler = app.extensions.get('scheduler')
+    if scheduler is None:
+        # Web-only process: the worker schedules them after its next sync
+        app.logger.info(f"No scheduler in this process, refetches for user {user_id} stay pending")
+        return 0
+
+    from app.scheduler import refetch_window_job
+
+    scheduled = 0
+    with _state_lock:
+        state = load_state(app.instance_path, user_id)
+        for issue in state['issues']:
+            if issue['status'] != 'pending':
+                continue
+            scheduler.add_job(
+                refetch_window_job, 'date',
+                run_date=datetime.now() + timedelta(seconds=REFETCH_DELAY),
+                id=f"refetch_{user_id}_{issue['account_id']}_{issue['date_from']}_{issue['date_to']}",
+                replace_existing=True,
+                args=[app, user_id, issue['account_id'], issue['date_from'], issue['date_to']],
+            )
+            issue['attempts'] += 1
+            issue['status'] = 'scheduled'
+            scheduled += 1
+        _save_state(app.instance_path, user_id, state)
+
+    return scheduled
+
+
+def refetch_done(instance_path, user_id, account_id, date_from, date_to):
+    """Mark a refetched window as pending again, so the next check decides if it is fixed"""
+    with _state_lock:
+        state = load_state(instance_path, user_id)
+        for issue in state['issues']:
+            if _issue_key(issue) == (account_id, date_from, date_to) and issue['status'] == 'scheduled':
+                issue['status'] = 'pending' if issue['attempts'] < MAX_REFETCH_ATTEMPTS else 'unresolved'
+        _save_state(instance_path, user_id, state)
+
+
+def merge_transactions(account, fetched):
+    """Add refetched booked transactions missing from an account, return how many were added"""
+    booked = account.setdefault('transactions', {}).setdefault('booked', [])
+    known = {transaction_key(tx) for tx in booked}
+    missing = [tx for tx in fetched.get('transactions', {}).get('booked', []) if transaction_key(tx) not in known]
+    if missing:
+        # Newest first, like the API returns them
+        booked.extend(missing)
+        booked.sort(key=lambda tx: transaction_date(tx) or '', reverse=True)
+    return len(missing)
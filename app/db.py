@@ -0,0 +1,167 @@
+"""
+This module handles the SQLite store for users and organisations.
+"""
+import os
+import sqlite3
+import click
+from flask import current_app, g
+from werkzeug.security import generate_password_hash
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS organisation (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    slug TEXT UNIQUE NOT NULL,
+    name TEXT NOT NULL,
+    is_public INTEGER NOT NULL DEFAULT 1
+);
+
+CREATE TABLE IF NOT EXISTS user (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT UNIQUE NOT NULL COLLATE NOCASE,
+    password_hash TEXT NOT NULL,
+    organisation_id INTEGER REFERENCES organisation (id),
+    is_admin INTEGER NOT NULL DEFAULT 0
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_organisation ON user (organisation_id);
+"""
+
+
+def get_db():
+    """Get the database connection of the current application context"""
+    if 'db' not in g:
+        # Async views run their coroutine on another thread than the request's,
+        # which uses the connection sequentially with it
+        g.db = sqlite3.connect(current_app.config['DATABASE'], check_same_thread=False)
+        g.db.row_factory = sqlite3.Row
+        g.db.execute('PRAGMA foreign_keys = ON')
+    return g.db
+
+
+def close_db(e=None):
+    db = g.pop('db', None)
+    if db is not None:
+        db.close()
+
+
+def init_db():
+    """Create the tables and seed the default organisation and admin user"""
+    db = get_db()
+    db.executescript(SCHEMA)
+
+    if db.execute('SELECT 1 FROM user LIMIT 1').fetchone() is None:
+        # First start: keep the historical admin (ID 1) so existing
+        # account_data_1.json files stay attached to it
+        db.execute(
+            'INSERT INTO organisation (id, slug, name, is_public) VALUES (1, ?, ?, 1)',
+            ('association', 'Association')
+        )
+        db.execute(
+            'INSERT INTO user (id, username, password_hash, organisation_id, is_admin) VALUES (1, ?, ?, 1, 1)',
+            ('admin', generate_password_hash(os.environ.get('ADMIN_PASSWORD', 'password')))
+        )
+    db.commit()
+
+
+def get_user_row(user_id):
+    return get_db().execute('SELECT * FROM user WHERE id = ?', (user_id,)).fetchone()
+
+
+def get_user_row_by_username(username):
+    # Uses the unique index on username
+    return get_db().execute('SELECT * FROM user WHERE username = ?', (username,)).fetchone()
+
+
+def get_organisation(organisation_id):
+    return get_db().execute('SELECT * FROM organisation WHERE id = ?', (organisation_id,)).fetchone()
+
+
+def get_organisation_by_slug(slug):
+    return get_db().execute('SELECT * FROM organisation WHERE slug = ?', (slug,)).fetchone()
+
+
+def get_default_organisation():
+    """The public organisation shown on /transparency for anonymous visitors"""
+    return get_db().execute(
+        'SELECT * FROM organisation WHERE is_public = 1 ORDER BY id LIMIT 1'
+    ).fetchone()
+
+
+def get_public_organisations():
+    return get_db().execute('SELECT * FROM organisation WHERE is_public = 1 ORDER BY name').fetchall()
+
+
+def get_organisation_user_ids(organisation_id):
+    """IDs of the users whose bank accounts belong to an organisation"""
+    rows = get_db().execute(
+        'SELECT id FROM user WHERE organisation_id = ? ORDER BY id', (organisation_id,)
+    ).fetchall()
+    return [row['id'] for row in rows]
+
+
+def get_all_user_ids():
+    return [row['id'] for row in get_db().execute('SELECT id FROM user ORDER BY id').fetchall()]
+
+
+def get_all_organisation_ids():
+    return [row['id'] for row in get_db().execute('SELECT id FROM organisation ORDER BY id').fetchall()]
+
+
+def create_organisation(slug, name, is_public=True):
+    db = get_db()
+    cursor = db.execute(
+        'INSERT INTO organisation (slug, name, is_public) VALUES (?, ?, ?)',
+        (slug, name, int(is_public))
+    )
+    db.commit()
+    return cursor.lastrowid
+
+
+def create_user(username, password, organisation_id, is_admin=False):
+    db = get_db()
+    cursor = db.execute(
+        'INSERT INTO user (username, password_hash, organisation_id, is_admin) VALUES (?, ?, ?, ?)',
+        (username, generate_password_hash(password), organisation_id, int(is_admin))
+    )
+    db.commit()
+    return cursor.lastrowid
+
+
+@click.command('create-organisation')
+@click.argument('slug')
+@click.argument('name')
+@click.option('--private', is_flag=True, help='Do not publish a public transparency page.')
+def create_organisation_command(slug, name, private):
+    """Create an organisation with its own transparency page."""
+    try:
+        organisation_id = create_organisation(slug, name, is_public=not private)
+    except sqlite3.IntegrityError:
+        raise click.ClickException(f"Organisation '{slug}' already exists")
+    click.echo(f"Created organisation {slug} (ID {organisation_id})")
+
+
+@click.command('create-user')
+@click.argument('username')
+@click.option('--organisation', 'organisation_slug', required=True, help='Slug of the organisation.')
+@click.option('--admin', is_flag=True, help='Give access to the administration pages.')
+@click.password_option()
+def create_user_command(username, organisation_slug, admin, password):
+    """Create a treasurer account for an organisation."""
+    organisation = get_organisation_by_slug(organisation_slug)
+    if organisation is None:
+        raise click.ClickException(f"Unknown organisation '{organisation_slug}'")
+    try:
+        user_id = create_user(username, password, organisation['id'], is_admin=admin)
+    except sqlite3.IntegrityError:
+        raise click.ClickException(f"User '{username}' already exists")
+    click.echo(f"Created user {username} (ID {user_id})")
+
+
+def init_app(app):
+    """Register the database with the application and create the tables"""
+    app.teardown_appcontext(close_db)
+    app.cli.add_command(create_organisation_command)
+    app.cli.add_command(create_user_command)
+
+    with app.app_context():
+        init_db()
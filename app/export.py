@@ -0,0 +1,191 @@
+"""
+This module exports the public transparency pages as static files.
+
+For every public organisation, the transparency page is rendered in every
+configured language, split into pages, and written next to paged JSON data
+and precompressed (.gz, and .br when brotli is installed) copies, so a plain
+web server or CDN can serve public traffic without the Python process:
+
+    <output>/static/...                      stylesheets used by the pages
+    <output>/organisations.json              list of exported organisations
+    <output>/<slug>/<lang>/index.html        first page, then page-2.html, ...
+    <output>/<slug>/data/summary.json        totals of the organisation
+    <output>/<slug>/data/transactions-1.json transactions, page by page
+"""
+import os
+import json
+import shutil
+import tempfile
+from datetime import datetime, timezone
+import click
+from flask import current_app, render_template
+from app import db
+from app.api import public_transaction
+from app.compression import compress_body, available_encodings
+
+
+def write_file(path, content):
+    """Write a file and its precompressed variants"""
+    if isinstance(content, str):
+        content = content.encode('utf-8')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(content)
+
+    # Same names as nginx gzip_static / brotli_static expect
+    extensions = {'gzip': '.gz', 'br': '.br'}
+    for encoding in available_encodings():
+        with open(path + extensions[encoding], 'wb') as f:
+            f.write(compress_body(content, encoding, 9))
+
+
+def write_json(path, data):
+    write_file(path, json.dumps(data, separators=(',', ':'), default=str))
+
+
+def page_file_name(number):
+    return 'index.html' if number == 1 else f'page-{number}.html'
+
+
+def paginate(items, page_size):
+    """Split a list into pages (always at least one, possibly empty, page)"""
+    return [items[i:i + page_size] for i in range(0, len(items), page_size)] or [[]]
+
+
+def export_organisation(app, organisation, output_dir, page_size):
+    """Render every page of an organisation's transparency page into output_dir"""
+    from app.routes import load_transparency_data
+
+    slug = organisation['slug']
+    with app.test_request_context(f'/transparency/{slug}'):
+        data = load_transparency_data(organisation)
+
+    transactions = data['transactions']
+    pages = paginate(transactions, page_size)
+
+    # Language independent data
+    data_dir = os.path.join(output_dir, 'data')
+    write_json(os.path.join(data_dir, 'summary.json'), {
+        'organisation': {'slug': slug, 'name': organisation['name']},
+        'total_balance': data['total_balance'],
+        'total_income': data['total_income'],
+        'total_expenses': data['total_expenses'],
+        'currency': data['currency'],
+        'number_of_accounts': data['number_of_accounts'],
+        'transaction_count': len(transactions),
+        'pages': len(pages),
+        'page_size': page_size,
+        'generated_at': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+    })
+    for number, page in enumerate(pages, start=1):
+        write_json(os.path.join(data_dir, f'transactions-{number}.json'), {
+            'page': number,
+            'pages': len(pages),
+            'next': f'transactions-{number + 1}.json' if number < len(pages) else None,
+            # Only the fields the JSON API publishes, not the raw bank records
+            'transactions': [public_transaction(tx, tx.get('account_id'), tx.get('status')) for tx in page],
+        })
+
+    # One HTML tree per language, selected the same way the app does (cookie).
+    # Babel caches the locale on the app context, so each language gets its own
+    for language in app.config['LANGUAGES']:
+        language_dir = os.path.join(output_dir, language)
+        with app.app_context(), app.test_request_context(f'/transparency/{slug}',
+                                                         headers={'Cookie': f'user_language={language}'}):
+            for number, page in enumerate(pages, start=1):
+                pagination = {
+                    'current': number,
+                    'pages': [{'number': n, 'url': page_file_name(n)} for n in range(1, len(pages) + 1)],
+                }
+                html = render_template('transparency.html',
+                                       organisation=organisation,
+                                       total_balance=data['total_balance'],
+                                       total_income=data['total_income'],
+                                       total_expenses=data['total_expenses'],
+                                       currency=data['currency'],
+                                       number_of_accounts=data['number_of_accounts'],
+                                       transactions=page,
+                                       transaction_count=len(transactions),
+                                       pagination=pagination,
+                                       # Links between the exported files instead of app routes
+                                       static_page=page_file_name(number))
+                write_file(os.path.join(language_dir, page_file_name(number)), html)
+
+    return len(pages)
+
+
+def replace_directory(source, target):
+    """Swap a freshly written directory into place"""
+    old = None
+    if os.path.exists(target):
+        old = target + '.old'
+        shutil.rmtree(old, ignore_errors=True)
+        os.replace(target, old)
+    os.replace(source, target)
+    if old:
+        shutil.rmtree(old, ignore_errors=True)
+
+
+def remove_stale_exports(output_dir, slugs):
+    """Delete the exports of organisations that are no longer public (or were deleted)"""
+    for name in os.listdir(output_dir):
+        path = os.path.join(output_dir, name)
+        # Only directories this module wrote, recognisable by their summary
+        if (name not in slugs and not name.startswith('.') and
+                os.path.isfile(os.path.join(path, 'data', 'summary.json'))):
+            shutil.rmtree(path, ignore_errors=True)
+
+
+def export_transparency(app, output_dir=None, page_size=None):
+    """Export the transparency pages of every public organisation"""
+    output_dir = output_dir or app.config['TRANSPARENCY_EXPORT_DIR'] or os.path.join(app.instance_path, 'export')
+    page_size = page_size or app.config['TRANSPARENCY_EXPORT_PAGE_SIZE']
+    os.makedirs(output_dir, exist_ok=True)
+
+    with app.app_context():
+        organisations = db.get_public_organisations()
+
+        exported = []
+        for organisation in organisations:
+            # Build each organisation next to the live one, then swap it in, so
+            # the web server never serves a half-written export
+            staging_dir = tempfile.mkdtemp(prefix=f".{organisation['slug']}-", dir=output_dir)
+            # mkdtemp creates a private directory, the web server must be able to read it
+            os.chmod(staging_dir, 0o755)
+            try:
+                pages = export_organisation(app, organisation, staging_dir, page_size)
+                replace_directory(staging_dir, os.path.join(output_dir, organisation['slug']))
+            except Exception:
+                shutil.rmtree(staging_dir, ignore_errors=True)
+                raise
+            exported.append({'slug': organisation['slug'], 'name': organisation['name'], 'pages': pages})
+
+        remove_stale_exports(output_dir, {organisation['slug'] for organisation in organisations})
+
+        write_json(os.path.join(output_dir, 'organisations.json'), {
+            'organisations': exported,
+            'languages': list(app.config['LANGUAGES']),
+        })
+
+    # Assets referenced by the pages (served under /static like in the app)
+    shutil.copytree(app.static_folder, os.path.join(output_dir, 'static'), dirs_exist_ok=True)
+
+    return output_dir, exported
+
+
+@click.command('transparency-export')
+@click.option('--output', 'output_dir', type=click.Path(file_okay=False), default=None,
+              help='Target directory (default: TRANSPARENCY_EXPORT_DIR or instance/export).')
+@click.option('--page-size', type=int, default=None, help='Transactions per page.')
+def transparency_export_command(output_dir, page_size):
+    """Render the public transparency pages to static files."""
+    output_dir, exported = export_transparency(current_app._get_current_object(), output_dir, page_size)
+    for organisation in exported:
+        click.echo(f"Exported {organisation['slug']}: {organisation['pages']} page(s)")
+    click.echo(f"Static transparency pages written to {output_dir}")
+
+
+def init_app(app):
+    app.config.setdefault('TRANSPARENCY_EXPORT_DIR', None)
+    app.config.setdefault('TRANSPARENCY_EXPORT_PAGE_SIZE', 100)
+    app.cli.add_command(transparency_export_command)
@@ -0,0 +1,355 @@
+"""
+This module keeps the instance directory from growing without bounds.
+
+A maintenance run, from the `instance-maintenance` command or the weekly
+scheduler job:
+    - removes the files and archive of users that no longer exist, and the
+      internal transfer index of deleted organisations
+    - removes cached bank lists (institutions_<user_id>.json) older than a week
+    - removes the stored data of accounts whose bank connection (requisition)
+      expired, was rejected or was deleted (the archive is kept unless asked);
+      nothing is removed unless every requisition could be listed
+    - drops pending transactions that reappeared as booked ones and rewrites
+      the JSON files compactly
+    - vacuums the SQLite database
+and reports disk usage and reclaimed space per user (projected by a dry run).
+"""
+import os
+import re
+import json
+import time
+import shutil
+from datetime import date
+import click
+from flask import current_app
+from app import db
+from app.archive import transaction_date, remove_account, archive_dir, load_index
+from app.sync import user_lock
+
+USER_FILE_PATTERN = re.compile(
+    r'^(account_data|account_ids|institutions|requisition_map|analysis|consistency)_(\d+)\.json$'
+)
+ORGANISATION_FILE_PATTERN = re.compile(r'^internal_transfers_(\d+)\.json$')
+
+# Requisition statuses after which the bank data can't be refreshed anymore
+EXPIRED_REQUISITION_STATUSES = {'EX', 'RJ'}
+# Requisitions fetched per page when listing them
+REQUISITIONS_PAGE_SIZE = 100
+# Age after which a cached list of banks is removed, it is fetched again when needed
+INSTITUTIONS_MAX_AGE = 7 * 24 * 3600
+# Days between a pending transaction and the booked transaction replacing it
+PENDING_BOOKING_DAYS = 7
+
+
+def path_size(path):
+    """Size of a file, or of everything under a directory"""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def user_paths(instance_path):
+    """Files and archive directory of every user found in the instance folder"""
+    paths = {}
+    for filename in os.listdir(instance_path):
+        match = USER_FILE_PATTERN.match(filename)
+        if match:
+            paths.setdefault(int(match.group(2)), []).append(os.path.join(instance_path, filename))
+
+    archive_root = os.path.join(instance_path, 'archive')
+    if os.path.isdir(archive_root):
+        for name in os.listdir(archive_root):
+            if name.isdigit():
+                paths.setdefault(int(name), []).append(os.path.join(archive_root, name))
+    return paths
+
+
+def disk_usage(instance_path):
+    """Bytes used by each user"""
+    return {user_id: sum(path_size(p) for p in paths) for user_id, paths in user_paths(instance_path).items()}
+
+
+def _load(path, default):
+    if not os.path.exists(path):
+        return default
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return default
+
+
+def _remove(path, dry_run):
+    size = path_size(path)
+    if not dry_run:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    return size
+
+
+def _description(tx):
+    return (tx.get('remittanceInformationUnstructured') or tx.get('creditorName') or
+            tx.get('debtorName') or '').strip().lower()
+
+
+def drop_booked_pending(account):
+    """Remove pending transactions that were booked since, return how many"""
+    transactions = account.get('transactions', {})
+    booked = transactions.get('booked', [])
+    pending = transactions.get('pending', [])
+    if not booked or not pending:
+        return 0
+
+    booked_ids = {tx['transactionId'] for tx in booked if tx.get('transactionId')}
+    by_content = {}
+    for tx in booked:
+        key = (str(tx.get('transactionAmount', {}).get('amount')), _description(tx))
+        by_content.setdefault(key, []).append(transaction_date(tx) or '')
+
+    kept = []
+    for tx in pending:
+        if tx.get('transactionId') and tx['transactionId'] in booked_ids:
+            continue
+
+        # Without a shared ID, the booked transaction has the same amount and
+        # description and is booked shortly after
+        key = (str(tx.get('transactionAmount', {}).get('amount')), _description(tx))
+        candidates = by_content.get(key, [])
+        pending_date = transaction_date(tx)
+        match = next((d for d in candidates if not pending_date or not d or
+                      0 <= _days_between(pending_date, d) <= PENDING_BOOKING_DAYS), None)
+        if match is not None:
+            # Each booked transaction replaces a single pending one
+            candidates.remove(match)
+            continue
+        kept.append(tx)
+
+    removed = len(pending) - len(kept)
+    transactions['pending'] = kept
+    return removed
+
+
+def _days_between(start, end):
+    return (date.fromisoformat(end) - date.fromisoformat(start)).days
+
+
+def requisition_statuses(client):
+    """
+    Status of every requisition known to the API, or None if the listing
+    can't be read completely
+    """
+    statuses = {}
+    offset = 0
+    try:
+        while True:
+            page = client.requisition.get_requisitions(limit=REQUISITIONS_PAGE_SIZE, offset=offset)
+            results = page.get('results', [])
+            statuses.update((r['id'], r.get('status')) for r in results)
+            offset += len(results)
+            if not page.get('next') or not results:
+                break
+    except Exception as e:
+        current_app.logger.warning(f"Maintenance: requisitions not checked: {str(e)}")
+        return None
+
+    if page.get('count') is not None and len(statuses) < page['count']:
+        current_app.logger.warning(f"Maintenance: requisitions not checked: listed {len(statuses)} "
+                                   f"of {page['count']}")
+        return None
+    return statuses
+
+
+def requisition_deleted(client, requisition_id):
+    """Whether the API confirms a requisition no longer exists"""
+    try:
+        client.requisition.get_requisition_by_id(requisition_id)
+    except Exception as e:
+        response = getattr(e, 'response', None)
+        return getattr(response, 'status_code', None) == 404
+    return False
+
+
+def expired_accounts(instance_path, user_id, client, statuses):
+    """Accounts of a user whose requisition expired, was rejected or was deleted"""
+    if statuses is None:
+        return set()
+    requisition_map = _load(os.path.join(instance_path, f'requisition_map_{user_id}.json'), {})
+
+    expired = set()
+    deleted = {}
+    for account_id, requisition_id in requisition_map.items():
+        if requisition_id in statuses:
+            if statuses[requisition_id] in EXPIRED_REQUISITION_STATUSES:
+                expired.add(account_id)
+            continue
+        # Missing from the listing is not enough, ask for the requisition itself
+        if requisition_id not in deleted:
+            deleted[requisition_id] = requisition_deleted(client, requisition_id)
+        if deleted[requisition_id]:
+            expired.add(account_id)
+    return expired
+
+
+def _rewrite(path, data, dry_run):
+    """Write a JSON file compactly, return the bytes saved"""
+    from app.nordigen_api import save_json_file
+
+    before = os.path.getsize(path)
+    if dry_run:
+        return before - len(json.dumps(data, separators=(',', ':')).encode('utf-8'))
+    save_json_file(path, data)
+    return before - os.path.getsize(path)
+
+
+def _archived_size(instance_path, user_id, account_id):
+    base = archive_dir(instance_path, user_id)
+    return sum(path_size(os.path.join(base, entry['file']))
+               for entry in load_index(instance_path, user_id)['partitions']
+               if entry['account_id'] == account_id and os.path.exists(os.path.join(base, entry['file'])))
+
+
+def compact_user(instance_path, user_id, expired, purge_archive=False, dry_run=False):
+    """
+    Remove expired accounts and booked pending transactions of a user, rewrite
+    compactly. Returns the actions and the bytes freed (or that would be freed).
+    """
+    actions = []
+    freed = 0
+    # A sync writing the same files waits until the user is compacted
+    with user_lock(instance_path, user_id):
+        data_file = os.path.join(instance_path, f'account_data_{user_id}.json')
+        accounts_data = _load(data_file, None)
+        if accounts_data is not None:
+            kept = [account for account in accounts_data if account.get('id') not in expired]
+            if len(kept) != len(accounts_data):
+                actions.append(f'removed {len(accounts_data) - len(kept)} expired account(s)')
+            dropped = sum(drop_booked_pending(account) for account in kept)
+            if dropped:
+                actions.append(f'dropped {dropped} booked pending transaction(s)')
+            freed += _rewrite(data_file, kept, dry_run)
+
+        ids_file = os.path.join(instance_path, f'account_ids_{user_id}.json')
+        account_ids = _load(ids_file, None)
+        if account_ids is not None:
+            freed += _rewrite(ids_file, [account_id for account_id in account_ids if account_id not in expired], dry_run)
+
+        map_file = os.path.join(instance_path, f'requisition_map_{user_id}.json')
+        requisition_map = _load(map_file, None)
+        if requisition_map is not None:
+            freed += _rewrite(map_file, {a: r for a, r in requisition_map.items() if a not in expired}, dry_run)
+
+        if purge_archive and expired:
+            for account_id in expired:
+                if dry_run:
+                    freed += _archived_size(instance_path, user_id, account_id)
+                else:
+                    freed += remove_account(instance_path, user_id, account_id)
+            actions.append(f'removed the archive of {len(expired)} expired account(s)')
+
+    return actions, freed
+
+
+def vacuum_database(dry_run=False):
+    """Rebuild the SQLite file without its free pages, return the bytes reclaimed"""
+    path = current_app.config['DATABASE']
+    if dry_run or not os.path.exists(path):
+        return 0
+    before = os.path.getsize(path)
+    db.get_db().execute('VACUUM')
+    return before - os.path.getsize(path)
+
+
+def run_maintenance(app, dry_run=False, purge_archive=False):
+    """Prune and compact the instance folder, return a report"""
+    instance_path = app.instance_path
+    report = {'users': {}, 'other': [], 'database_reclaimed': 0, 'dry_run': dry_run}
+
+    with app.app_context():
+        user_ids = set(db.get_all_user_ids())
+        organisation_ids = set(db.get_all_organisation_ids())
+        before = disk_usage(instance_path)
+
+        from app.nordigen_api import get_client
+        try:
+            client = get_client()
+            statuses = requisition_statuses(client)
+        except Exception as e:
+            current_app.logger.warning(f"Maintenance: requisitions not checked: {str(e)}")
+            client, statuses = None, None
+        if statuses == {}:
+            # Wrong credentials or project rather than every connection gone
+            current_app.logger.warning("Maintenance: no requisitions listed, expired accounts not removed")
+            statuses = None
+        if statuses is None:
+            report['other'].append('requisitions not checked: expired accounts were kept')
+
+        for user_id, paths in sorted(user_paths(instance_path).items()):
+            entry = report['users'][user_id] = {'before': before.get(user_id, 0), 'actions': [], 'freed': 0}
+
+            if user_id not in user_ids:
+                freed = sum(_remove(path, dry_run) for path in paths)
+                entry['freed'] += freed
+                entry['actions'].append(f'removed files of deleted user ({freed} bytes)')
+                continue
+
+            institutions_file = os.path.join(instance_path, f'institutions_{user_id}.json')
+            if (os.path.exists(institutions_file) and
+                    time.time() - os.path.getmtime(institutions_file) > INSTITUTIONS_MAX_AGE):
+                entry['freed'] += _remove(institutions_file, dry_run)
+                entry['actions'].append('removed stale list of banks')
+
+            expired = expired_accounts(instance_path, user_id, client, statuses)
+            actions, freed = compact_user(instance_path, user_id, expired, purge_archive, dry_run)
+            entry['actions'].extend(actions)
+            entry['freed'] += freed
+
+        for filename in os.listdir(instance_path):
+            path = os.path.join(instance_path, filename)
+            match = ORGANISATION_FILE_PATTERN.match(filename)
+            if match and int(match.group(1)) not in organisation_ids:
+                report['other'].append(f'{filename}: removed, organisation was deleted ({_remove(path, dry_run)} bytes)')
+            elif filename.endswith('.tmp') and time.time() - os.path.getmtime(path) > 3600:
+                # Left behind by an interrupted write
+                report['other'].append(f'{filename}: removed interrupted write ({_remove(path, dry_run)} bytes)')
+
+        report['database_reclaimed'] = vacuum_database(dry_run)
+
+    after = disk_usage(instance_path)
+    for user_id, entry in report['users'].items():
+        # A dry run reports the size the user would have after compaction
+        freed = entry.pop('freed')
+        entry['after'] = entry['before'] - freed if dry_run else after.get(user_id, 0)
+        entry['reclaimed'] = entry['before'] - entry['after']
+    return report
+
+
+@click.command('instance-maintenance')
+@click.option('--dry-run', is_flag=True, help='Report what would be removed without changing anything.')
+@click.option('--purge-archive', is_flag=True, help='Also delete the archived history of expired accounts.')
+def instance_maintenance_command(dry_run, purge_archive):
+    """Prune orphaned and expired data, compact stored history and report disk usage."""
+    report = run_maintenance(current_app._get_current_object(), dry_run=dry_run, purge_archive=purge_archive)
+
+    click.echo(f"{'User':>6} {'Before':>12} {'After':>12} {'Reclaimed':>12}")
+    for user_id, entry in report['users'].items():
+        click.echo(f"{user_id:>6} {entry['before']:>12} {entry['after']:>12} {entry['reclaimed']:>12}")
+        for action in entry['actions']:
+            click.echo(f"{'':>8}{action}")
+    for line in report['other']:
+        click.echo(line)
+    click.echo(f"Database: {report['database_reclaimed']} bytes reclaimed")
+    if dry_run:
+        click.echo("Dry run: nothing was changed")
+
+
+def init_app(app):
+    app.cli.add_command(instance_maintenance_command)
@@ -1,36 +1,45 @@
 import os
 import json
 from datetime import datetime
-from flask import Blueprint, redirect, url_for, session, request, render_template, flash, current_app
+from flask import Blueprint, redirect, url_for, session, request, render_template, flash, current_app, jsonify, abort
 from flask_login import login_required, current_user
-from nordigen import NordigenClient
+from app.archive import archive_closed_months, remove_account as remove_archived_account
+from app.archive import load_index as load_archive_index
+from app.transfers import remove_account_transfers
+from app.sync import SyncPipeline, SyncTarget, fetch_account, normalize_account, format_stages, user_lock
+from app.sync import keep_stored_transactions, load_stored_accounts
 
 nordigen_bp = Blueprint('nordigen', __name__, url_prefix='/nordigen')
 
 def get_client():
-    """Initialize Nordigen client with credentials from environment variables"""
+    """Get the shared Nordigen client with credentials from environment variables"""
     secret_id = os.environ.get('NORDIGEN_SECRET_ID')
     secret_key = os.environ.get('NORDIGEN_SECRET_KEY')
     
     if not secret_id or not secret_key:
         raise ValueError("Nordigen credentials are not configured")
     
-    client = NordigenClient(
-        secret_id=secret_id,
-        secret_key=secret_key
-    )
-    
-    # Ensure we have a valid token
+    # Imported here so processes that never call the API don't load the SDK
+    from app.nordigen_client import get_shared_client
+
+    # The client, its HTTP connection pool and its access token are shared by
+    # all requests and the scheduler; the token is only renewed when it expires
     try:
-        # Generate a new access token
-        token_data = client.generate_token()
-        current_app.logger.info("New token successfully generated")
+        client = get_shared_client(secret_id, secret_key, current_app.config, logger=current_app.logger)
     except Exception as e:
         current_app.logger.error(f"Error generating token: {str(e)}")
         raise
     
     return client
 
+def save_json_file(file_path, data):
+    """Write a JSON file compactly, replacing it atomically"""
+    tmp_path = file_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f, separators=(',', ':'))
+    os.replace(tmp_path, file_path)
+    return file_path
+
 def save_institutions_to_file(institutions, user_id):
     """Save institutions data to a file instead of session"""
     file_path = os.path.join(current_app.instance_path, f'institutions_{user_id}.json')
@@ -61,6 +70,52 @@ def get_account_ids_from_file(user_id):
             return json.load(f)
     return []
 
+def save_account_data_to_file(accounts_data, user_id):
+    """Save account data to the hot store, rolling closed months into the archive"""
+    # Look for anomalies among the new transactions before anything is archived
+    try:
+        from app.analysis import analyse_accounts
+        anomalies = analyse_accounts(current_app.instance_path, user_id, accounts_data)
+        if anomalies:
+            current_app.logger.warning(f"{len(anomalies)} anomalous transaction(s) found for user {user_id}")
+    except Exception as e:
+        current_app.logger.error(f"Error analysing transactions for user {user_id}: {str(e)}")
+    
+    # Check the history adds up to the balances, refetch the windows that don't
+    try:
+        from app.consistency import check_accounts, schedule_refetches
+        issues = check_accounts(current_app.instance_path, user_id, accounts_data)
+        if issues:
+            current_app.logger.warning(f"{len(issues)} inconsistent date window(s) found for user {user_id}")
+            schedule_refetches(current_app._get_current_object(), user_id)
+    except Exception as e:
+        current_app.logger.error(f"Error checking balances for user {user_id}: {str(e)}")
+    
+    # Record transfers between the organisation's own accounts, so totals can leave them out
+    try:
+        from app.transfers import update_user_transfers
+        update_user_transfers(current_app.instance_path, user_id, accounts_data)
+    except Exception as e:
+        current_app.logger.error(f"Error matching internal transfers for user {user_id}: {str(e)}")
+    
+    # Maintenance may be compacting the same files
+    with user_lock(current_app.instance_path, user_id):
+        stored = load_stored_accounts(current_app.instance_path, user_id)
+        accounts_data = keep_stored_transactions(stored, accounts_data)
+        accounts_data = archive_closed_months(current_app.instance_path, user_id, accounts_data)
+        file_path = os.path.join(current_app.instance_path, f'account_data_{user_id}.json')
+        return save_json_file(file_path, accounts_data)
+
+@nordigen_bp.route('/pool-stats')
+@login_required
+def pool_stats():
+    """Connection pool utilization of the shared Nordigen client"""
+    if not current_user.is_admin:
+        abort(403)
+    
+    from app.nordigen_client import get_pool_stats
+    return jsonify(get_pool_stats() or {'pool_size': current_app.config['NORDIGEN_POOL_SIZE'], 'requests': 0})
+
 @nordigen_bp.route('/init')
 @login_required
 def init_nordigen():
@@ -216,32 +271,14 @@ def list_accounts():
         for account_id in account_ids:
             try:
                 # Get basic account information from API
-                account = client.account_api(account_id)
-                transactions = account.get_transactions()
-                account_details = account.get_details()
-                account_balances = account.get_balances()
-                
-                # Ensure transactions structure is correct
-                if 'transactions' not in transactions:
-                    transactions = {'transactions': {'booked': [], 'pending': []}}
-
-                # Store data in our list
-                accounts_data.append({
-                    'id': account_id,
-                    'name': account_details.get('account', {}).get('name', 'Unnamed account'),
-                    'iban': account_details.get('account', {}).get('iban', 'IBAN not available'),
-                    'currency': account_details.get('account', {}).get('currency', 'EUR'),
-                    'balances': account_balances.get('balances', []),
-                    'transactions': transactions.get('transactions', {'booked': [], 'pending': []})
-
-                })
+                raw = fetch_account(client, account_id)
+                accounts_data.append(normalize_account(account_id, raw['details'], raw['balances'], raw['transactions']))
                 
             except Exception as e:
                 current_app.logger.error(f"Error retrieving account details for {account_id}: {str(e)}")
         
         # Cache account data for later use (but don't rely on this for retrievals)
-        with open(os.path.join(current_app.instance_path, f'account_data_{current_user.id}.json'), 'w') as f:
-            json.dump(accounts_data, f, indent=4)
+        save_account_data_to_file(accounts_data, current_user.id)
         
         # Store mapping between account IDs and requisition IDs for deletion purposes
         requisition_map_file = os.path.join(current_app.instance_path, f'requisition_map_{current_user.id}.json')
@@ -259,8 +296,7 @@ def list_accounts():
             requisition_map[account_id] = requisition_id
             
         # Save the updated mapping
-        with open(requisition_map_file, 'w') as f:
-            json.dump(requisition_map, f, indent=4)
+        save_json_file(requisition_map_file, requisition_map)
             
         return render_template('accounts.html', accounts=accounts_data)
         
@@ -277,30 +313,8 @@ def view_transactions(account_id):
     
     try:
         # Get all account information directly from Nordigen API
-        account_api = client.account_api(account_id)
-        transactions = account_api.get_transactions()
-        account_details = account_api.get_details()
-        account_balances = account_api.get_balances()
-        
-        # Ensure transactions structure is correct
-        if 'transactions' not in transactions:
-            transactions = {'transactions': {'booked': [], 'pending': []}}
-        
-        # Create full account object from API data
-        current_account = {
-            'id': account_id,
-            'name': account_details.get('account', {}).get('name', 'Unnamed account'),
-            'iban': account_details.get('account', {}).get('iban', 'IBAN not available'),
-            'currency': account_details.get('account', {}).get('currency', 'EUR'),
-            'balances': account_balances.get('balances', []),
-            'transactions': transactions.get('transactions', {'booked': [], 'pending': []})
-        }
-        
-        # Ensure required transaction keys exist
-        if 'booked' not in current_account['transactions']:
-            current_account['transactions']['booked'] = []
-        if 'pending' not in current_account['transactions']:
-            current_account['transactions']['pending'] = []
+        raw = fetch_account(client, account_id)
+        current_account = normalize_account(account_id, raw['details'], raw['balances'], raw['transactions'])
         
         # Update cache file if it exists (but don't rely on it for retrievals)
         data_file = os.path.join(current_app.instance_path, f'account_data_{current_user.id}.json')
@@ -321,8 +335,7 @@ def view_transactions(account_id):
                     accounts_data.append(current_account)
                 
                 # Write updated cache
-                with open(data_file, 'w') as f:
-                    json.dump(accounts_data, f, indent=4)
+                save_account_data_to_file(accounts_data, current_user.id)
             except Exception as e:
                 current_app.logger.warning(f"Could not update cache file: {str(e)}")
         
@@ -367,8 +380,7 @@ def delete_account(account_id):
                     if account_id in req_details.get('accounts', []):
                         requisition_map[account_id] = req['id']
                         # Save the updated mapping
-                        with open(requisition_map_file, 'w') as f:
-                            json.dump(requisition_map, f, indent=4)
+                        save_json_file(requisition_map_file, requisition_map)
                         break
             except Exception as e:
                 current_app.logger.error(f"Error searching requisitions for account {account_id}: {str(e)}")
@@ -385,8 +397,7 @@ def delete_account(account_id):
                 del requisition_map[account_id]
                 
                 # Save updated mapping
-                with open(requisition_map_file, 'w') as f:
-                    json.dump(requisition_map, f, indent=4)
+                save_json_file(requisition_map_file, requisition_map)
             except Exception as e:
                 current_app.logger.error(f"Error deleting requisition from Nordigen API: {str(e)}")
                 flash(f"Warning: Could not delete account from Nordigen API: {str(e)}", "warning")
@@ -402,11 +413,15 @@ def delete_account(account_id):
                 accounts_data = [acc for acc in accounts_data if acc['id'] != account_id]
                 
                 # Update data file
-                with open(data_file, 'w') as f:
-                    json.dump(accounts_data, f, indent=4)
+                save_json_file(data_file, accounts_data)
             except Exception as e:
                 current_app.logger.warning(f"Could not update cache file: {str(e)}")
         
+        # Its archived history and transfers would still count in the totals
+        remove_archived_account(current_app.instance_path, current_user.id, account_id)
+        if current_user.organisation_id:
+            remove_account_transfers(current_app.instance_path, current_user.organisation_id, account_id)
+        
         flash("Account was successfully deleted.", "success")
         
     except Exception as e:
@@ -443,11 +458,28 @@ def delete_all_accounts():
                 current_app.logger.error(f"Error deleting requisition {req['id']}: {str(e)}")
                 error_count += 1
         
+        # Forget the archived history and transfers of the accounts
+        data_file = os.path.join(current_app.instance_path, f'account_data_{current_user.id}.json')
+        account_ids = set(get_account_ids_from_file(current_user.id))
+        if os.path.exists(data_file):
+            with open(data_file, 'r') as f:
+                try:
+                    account_ids.update(account.get('id') for account in json.load(f))
+                except json.JSONDecodeError:
+                    pass
+        account_ids.update(entry['account_id'] for entry in load_archive_index(current_app.instance_path, current_user.id)['partitions'])
+        for account_id in account_ids:
+            remove_archived_account(current_app.instance_path, current_user.id, account_id)
+            if current_user.organisation_id:
+                remove_account_transfers(current_app.instance_path, current_user.organisation_id, account_id)
+        
         # Clean up local cache files
         files_to_clean = [
             os.path.join(current_app.instance_path, f'account_data_{current_user.id}.json'),
             os.path.join(current_app.instance_path, f'account_ids_{current_user.id}.json'),
-            os.path.join(current_app.instance_path, f'requisition_map_{current_user.id}.json')
+            os.path.join(current_app.instance_path, f'requisition_map_{current_user.id}.json'),
+            os.path.join(current_app.instance_path, f'analysis_{current_user.id}.json'),
+            os.path.join(current_app.instance_path, f'consistency_{current_user.id}.json')
         ]
         
         for file_path in files_to_clean:
@@ -489,63 +521,27 @@ def refresh_accounts():
         # Sort by created date (newest first) and get all account IDs
         user_requisitions.sort(key=lambda r: r.get('created', ''), reverse=True)
         
-        # Create a list for all account IDs from all requisitions
+        # Get all account IDs, and the requisition of each one for deletion purposes
         all_account_ids = []
+        requisition_map = {}
         for req in user_requisitions:
             req_details = client.requisition.get_requisition_by_id(req['id'])
-            all_account_ids.extend(req_details.get('accounts', []))
+            for acc_id in req_details.get('accounts', []):
+                all_account_ids.append(acc_id)
+                requisition_map[acc_id] = req['id']
         
         if not all_account_ids:
             flash("No accounts to refresh.", "info")
             return redirect(url_for('main.dashboard'))
         
-        # Refresh information for each account
-        updated_accounts = []
-        for account_id in all_account_ids:
-            try:
-                # Get updated account information directly from API
-                account_api = client.account_api(account_id)
-                account_details = account_api.get_details()
-                account_balances = account_api.get_balances()
-                account_transactions = account_api.get_transactions()
-                
-                # Create updated account object from fresh API data
-                updated_account = {
-                    'id': account_id,
-                    'name': account_details.get('account', {}).get('name', 'Unnamed account'),
-                    'iban': account_details.get('account', {}).get('iban', 'IBAN not available'),
-                    'currency': account_details.get('account', {}).get('currency', 'EUR'),
-                    'balances': account_balances.get('balances', []),
-                    'transactions': account_transactions.get('transactions', {'booked': [], 'pending': []})
-                }
-                
-                # Ensure required keys exist for transactions
-                if 'booked' not in updated_account['transactions']:
-                    updated_account['transactions']['booked'] = []
-                if 'pending' not in updated_account['transactions']:
-                    updated_account['transactions']['pending'] = []
-                
-                updated_accounts.append(updated_account)
-                
-            except Exception as e:
-                current_app.logger.error(f"Error refreshing account {account_id}: {str(e)}")
-        
-        # Update the cache file with fresh data
-        data_file = os.path.join(current_app.instance_path, f'account_data_{current_user.id}.json')
-        with open(data_file, 'w') as f:
-            json.dump(updated_accounts, f, indent=4)
-        
-        # Update mapping between account IDs and requisition IDs
-        requisition_map = {}
-        for req in user_requisitions:
-            req_details = client.requisition.get_requisition_by_id(req['id'])
-            for acc_id in req_details.get('accounts', []):
-                requisition_map[acc_id] = req['id']
+        # Fetch every account concurrently, then store the user's data if it changed
+        pipeline = SyncPipeline(current_app._get_current_object(), client)
+        report = pipeline.run([SyncTarget(current_user.id, all_account_ids)])
+        current_app.logger.info(f"Refreshed accounts of user {current_user.id}: {format_stages(report['stages'])}")
                 
         # Save the updated mapping
         requisition_map_file = os.path.join(current_app.instance_path, f'requisition_map_{current_user.id}.json')
-        with open(requisition_map_file, 'w') as f:
-            json.dump(requisition_map, f, indent=4)
+        save_json_file(requisition_map_file, requisition_map)
         
         flash("All accounts were successfully refreshed.", "success")
         
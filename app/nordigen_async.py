@@ -0,0 +1,238 @@
+"""
+This module provides the async mode of the Nordigen blueprint.
+
+With NORDIGEN_ASYNC enabled, the views that wait on many bank API calls
+(account list, transactions, refresh) are replaced by async versions that
+send those calls concurrently with httpx instead of one after the other.
+Access tokens come from the shared synchronous client (app/nordigen_client.py).
+"""
+import os
+import json
+import asyncio
+import httpx
+from flask import redirect, url_for, session, render_template, flash, current_app
+from flask_login import login_required, current_user
+from app.nordigen_api import get_client, save_account_ids_to_file, save_account_data_to_file, save_json_file
+from app.sync import SyncPipeline, SyncTarget, normalize_account
+
+
+class AsyncNordigenClient:
+    """Minimal async client for the Nordigen endpoints used by the views"""
+
+    def __init__(self, base_url, token, connect_timeout=5, read_timeout=30, pool_size=10):
+        self._client = httpx.AsyncClient(
+            base_url=base_url.rstrip('/') + '/',
+            headers={
+                'accept': 'application/json',
+                'User-Agent': 'Nordigen-Python-v2',
+                'Authorization': f'Bearer {token}',
+            },
+            timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+        # Bounds the number of calls in flight, like the synchronous pool
+        self._semaphore = asyncio.Semaphore(pool_size)
+
+    async def get(self, endpoint, params=None):
+        async with self._semaphore:
+            response = await self._client.get(endpoint, params=params)
+        response.raise_for_status()
+        return response.json()
+
+    async def get_requisitions(self):
+        return await self.get('requisitions/')
+
+    async def get_requisition_by_id(self, requisition_id):
+        return await self.get(f'requisitions/{requisition_id}/')
+
+    async def get_account(self, account_id):
+        """Get details, balances and transactions of an account concurrently"""
+        details, balances, transactions = await asyncio.gather(
+            self.get(f'accounts/{account_id}/details/'),
+            self.get(f'accounts/{account_id}/balances/'),
+            self.get(f'accounts/{account_id}/transactions/'),
+        )
+        return normalize_account(account_id, details, balances, transactions)
+
+    async def get_accounts(self, account_ids):
+        """Get several accounts concurrently, by ID, skipping (and logging) the ones that fail"""
+        results = await asyncio.gather(
+            *(self.get_account(account_id) for account_id in account_ids),
+            return_exceptions=True
+        )
+        accounts = {}
+        for account_id, result in zip(account_ids, results):
+            if isinstance(result, Exception):
+                current_app.logger.error(f"Error retrieving account details for {account_id}: {str(result)}")
+            else:
+                accounts[account_id] = result
+        return accounts
+
+    async def aclose(self):
+        await self._client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+
+def get_async_client():
+    """Create an async client for the current request, reusing the shared access token"""
+    # The event loop only lives for one request, so the httpx client can't be shared
+    client = get_client()
+    config = current_app.config
+    return AsyncNordigenClient(
+        client.base_url,
+        client.token,
+        connect_timeout=config['NORDIGEN_CONNECT_TIMEOUT'],
+        read_timeout=config['NORDIGEN_READ_TIMEOUT'],
+        pool_size=config['NORDIGEN_POOL_SIZE'],
+    )
+
+
+async def get_user_requisitions(client):
+    """Requisitions of the current user, newest first"""
+    requisitions = await client.get_requisitions()
+    user_requisitions = [r for r in requisitions['results']
+                         if r['reference'].startswith(f"user_{current_user.id}_")]
+    user_requisitions.sort(key=lambda r: r.get('created', ''), reverse=True)
+    return user_requisitions
+
+
+def save_requisition_map(requisition_map, merge=True):
+    """Save the mapping between account IDs and requisition IDs for deletion purposes"""
+    requisition_map_file = os.path.join(current_app.instance_path, f'requisition_map_{current_user.id}.json')
+    if merge and os.path.exists(requisition_map_file):
+        try:
+            with open(requisition_map_file, 'r') as f:
+                requisition_map = {**json.load(f), **requisition_map}
+        except json.JSONDecodeError:
+            pass
+
+    save_json_file(requisition_map_file, requisition_map)
+
+
+async def list_accounts():
+    """Display list of available accounts directly from Nordigen API"""
+    try:
+        async with get_async_client() as client:
+            # Get requisition ID from session
+            requisition_id = session.get('requisition_id')
+
+            if not requisition_id:
+                # Try to find the latest requisition for this user directly from Nordigen
+                try:
+                    user_requisitions = await get_user_requisitions(client)
+                except Exception as e:
+                    current_app.logger.error(f"Error fetching requisitions: {str(e)}")
+                    flash("No active bank connections found. Please connect a bank account.", "warning")
+                    return redirect(url_for('nordigen.init_nordigen'))
+
+                if not user_requisitions:
+                    flash("No accounts available. Please connect a bank account first.", "info")
+                    return redirect(url_for('nordigen.init_nordigen'))
+                requisition_id = user_requisitions[0]['id']
+                current_app.logger.info(f"Found existing requisition {requisition_id} for user {current_user.id}")
+
+            requisition = await client.get_requisition_by_id(requisition_id)
+            account_ids = requisition.get('accounts', [])
+
+            if not account_ids:
+                flash("No accounts available. Please try again.", "error")
+                return redirect(url_for('nordigen.init_nordigen'))
+
+            save_account_ids_to_file(account_ids, current_user.id)
+
+            # Every account, and every call per account, is fetched concurrently
+            accounts = await client.get_accounts(account_ids)
+
+        # Accounts that failed to load keep their stored data
+        pipeline = SyncPipeline(current_app._get_current_object())
+        accounts_data = pipeline.publish(SyncTarget(current_user.id, account_ids), accounts)['accounts']
+        save_requisition_map({account_id: requisition_id for account_id in account_ids})
+
+        return render_template('accounts.html', accounts=accounts_data)
+
+    except Exception as e:
+        current_app.logger.error(f"Error retrieving account details: {str(e)}")
+        flash(f"Error retrieving account details: {str(e)}", "error")
+        return redirect(url_for('nordigen.init_nordigen'))
+
+
+async def view_transactions(account_id):
+    """Display transactions for a specific account directly from Nordigen API"""
+    try:
+        async with get_async_client() as client:
+            current_account = await client.get_account(account_id)
+
+        # Update cache file if it exists (but don't rely on it for retrievals)
+        data_file = os.path.join(current_app.instance_path, f'account_data_{current_user.id}.json')
+        if os.path.exists(data_file):
+            try:
+                with open(data_file, 'r') as f:
+                    accounts_data = json.load(f)
+
+                accounts_data = [acc for acc in accounts_data if acc['id'] != account_id] + [current_account]
+                save_account_data_to_file(accounts_data, current_user.id)
+            except Exception as e:
+                current_app.logger.warning(f"Could not update cache file: {str(e)}")
+
+        return render_template('transactions.html',
+                            account=current_account,
+                            transactions=current_account['transactions'])
+
+    except Exception as e:
+        current_app.logger.error(f"Error retrieving transactions: {str(e)}")
+        flash(f"Error retrieving transactions: {str(e)}", "error")
+        return redirect(url_for('nordigen.list_accounts'))
+
+
+async def refresh_accounts():
+    """Refresh data for all user accounts directly from Nordigen API"""
+    try:
+        async with get_async_client() as client:
+            user_requisitions = await get_user_requisitions(client)
+
+            if not user_requisitions:
+                flash("No accounts to refresh. Please connect a bank account first.", "warning")
+                return redirect(url_for('nordigen.init_nordigen'))
+
+            # Get every requisition's accounts concurrently
+            requisitions = await asyncio.gather(
+                *(client.get_requisition_by_id(req['id']) for req in user_requisitions)
+            )
+            requisition_map = {}
+            all_account_ids = []
+            for req, req_details in zip(user_requisitions, requisitions):
+                for acc_id in req_details.get('accounts', []):
+                    requisition_map[acc_id] = req['id']
+                    all_account_ids.append(acc_id)
+
+            if not all_account_ids:
+                flash("No accounts to refresh.", "info")
+                return redirect(url_for('main.dashboard'))
+
+            accounts = await client.get_accounts(all_account_ids)
+
+        # Same comparison and publishing as the daily sync: accounts that
+        # failed to load keep their stored data
+        pipeline = SyncPipeline(current_app._get_current_object())
+        pipeline.publish(SyncTarget(current_user.id, all_account_ids), accounts)
+        save_requisition_map(requisition_map, merge=False)
+
+        flash("All accounts were successfully refreshed.", "success")
+
+    except Exception as e:
+        current_app.logger.error(f"Error refreshing accounts: {str(e)}")
+        flash(f"Error refreshing accounts: {str(e)}", "error")
+
+    return redirect(url_for('main.dashboard'))
+
+
+def init_app(app):
+    """Replace the I/O-bound Nordigen views with their async versions"""
+    app.view_functions['nordigen.list_accounts'] = login_required(list_accounts)
+    app.view_functions['nordigen.view_transactions'] = login_required(view_transactions)
+    app.view_functions['nordigen.refresh_accounts'] = login_required(refresh_accounts)
@@ -0,0 +1,170 @@
+"""
+This module provides a long-lived Nordigen client sharing one pooled HTTP session.
+
+The Nordigen SDK sends every call with the module-level requests functions, which
+open a new TCP+TLS connection each time. PooledNordigenClient sends them through
+a requests.Session instead, so connections to the GoCardless API are kept alive
+and reused by every route and by the scheduler.
+"""
+import json
+import time
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from requests.models import HTTPError
+from nordigen import NordigenClient
+
+# Renew the access token this many seconds before it expires
+TOKEN_RENEWAL_MARGIN = 60
+
+
+class PooledNordigenClient(NordigenClient):
+    """Thread-safe Nordigen client using a pooled, keep-alive HTTP session"""
+
+    def __init__(self, secret_id, secret_key, pool_size=10, pool_block=True,
+                 connect_timeout=5, read_timeout=30, base_url=None, logger=None):
+        super().__init__(secret_key=secret_key, secret_id=secret_id)
+        if base_url:
+            self.base_url = base_url
+        self._timeout = (connect_timeout, read_timeout)
+        self.pool_size = pool_size
+        self.logger = logger
+
+        # With pool_block, callers wait for a free connection instead of opening
+        # throwaway connections once all pooled ones are in use
+        self.adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, pool_block=pool_block)
+        self.session = requests.Session()
+        self.session.mount('https://', self.adapter)
+        self.session.mount('http://', self.adapter)
+
+        self._token_lock = threading.Lock()
+        self._access_expires_at = 0
+        self._refresh_token = None
+        self._refresh_expires_at = 0
+
+        self._stats_lock = threading.Lock()
+        self._in_flight = 0
+        self._peak_in_flight = 0
+        self._requests = 0
+        self._errors = 0
+
+    def ensure_token(self):
+        """Get a new access token if the current one is missing or about to expire"""
+        if time.monotonic() < self._access_expires_at - TOKEN_RENEWAL_MARGIN:
+            return
+
+        with self._token_lock:
+            now = time.monotonic()
+            if now < self._access_expires_at - TOKEN_RENEWAL_MARGIN:
+                # Another thread renewed it while we were waiting
+                return
+
+            if self._refresh_token and now < self._refresh_expires_at - TOKEN_RENEWAL_MARGIN:
+                token_data = self.exchange_token(self._refresh_token)
+            else:
+                token_data = self.generate_token()
+                self._refresh_token = token_data.get('refresh')
+                self._refresh_expires_at = now + token_data.get('refresh_expires', 0)
+            self._access_expires_at = now + token_data.get('access_expires', 0)
+
+            if self.logger:
+                self.logger.info("New token successfully generated")
+
+    def request(self, method, endpoint, data=None, headers=None):
+        """Same as NordigenClient.request, sent through the pooled session"""
+        request_meta = {
+            "url": f"{self.base_url}/{endpoint}",
+            "headers": headers if headers else self._headers,
+            "timeout": self._timeout,
+        }
+
+        data = self.data_filter.filter_payload(data)
+        if method.value in ('GET', 'DELETE'):
+            request_meta['params'] = data
+        else:
+            request_meta['data'] = json.dumps(data)
+
+        with self._stats_lock:
+            self._in_flight += 1
+            self._requests += 1
+            self._peak_in_flight = max(self._peak_in_flight, self._in_flight)
+        try:
+            response = self.session.request(method.value, **request_meta)
+        except requests.RequestException:
+            with self._stats_lock:
+                self._errors += 1
+            raise
+        finally:
+            with self._stats_lock:
+                self._in_flight -= 1
+
+        if response.ok:
+            return response.json()
+
+        with self._stats_lock:
+            self._errors += 1
+        raise HTTPError(
+            {"response": response.json(), "status": response.status_code}, response=response
+        )
+
+    def pool_stats(self):
+        """Utilization of the connection pool, to size it against the concurrency we run"""
+        with self._stats_lock:
+            stats = {
+                'pool_size': self.pool_size,
+                'in_flight': self._in_flight,
+                'peak_in_flight': self._peak_in_flight,
+                'requests': self._requests,
+                'errors': self._errors,
+            }
+
+        # One urllib3 pool per host, the idle queue holds reusable connections
+        hosts = []
+        for key in list(self.adapter.poolmanager.pools.keys()):
+            pool = self.adapter.poolmanager.pools.get(key)
+            if pool is None:
+                continue
+            hosts.append({
+                'host': pool.host,
+                'connections_opened': pool.num_connections,
+                'requests': pool.num_requests,
+                'idle_connections': sum(1 for conn in list(pool.pool.queue) if conn is not None) if pool.pool else 0,
+            })
+        stats['hosts'] = hosts
+        stats['utilization'] = round(stats['peak_in_flight'] / self.pool_size, 2) if self.pool_size else None
+        return stats
+
+
+_shared_client = None
+_shared_client_lock = threading.Lock()
+
+
+def get_shared_client(secret_id, secret_key, config, logger=None):
+    """Get the process-wide client, creating it on first use"""
+    global _shared_client
+
+    client = _shared_client
+    if client is None or client.secret_id != secret_id or client.secret_key != secret_key:
+        with _shared_client_lock:
+            client = _shared_client
+            if client is None or client.secret_id != secret_id or client.secret_key != secret_key:
+                client = PooledNordigenClient(
+                    secret_id=secret_id,
+                    secret_key=secret_key,
+                    pool_size=config['NORDIGEN_POOL_SIZE'],
+                    pool_block=config['NORDIGEN_POOL_BLOCK'],
+                    connect_timeout=config['NORDIGEN_CONNECT_TIMEOUT'],
+                    read_timeout=config['NORDIGEN_READ_TIMEOUT'],
+                    base_url=config.get('NORDIGEN_BASE_URL'),
+                    logger=logger,
+                )
+                _shared_client = client
+
+    client.ensure_token()
+    return client
+
+
+def get_pool_stats():
+    """Pool statistics of the shared client, or None if no API call was made yet"""
+    client = _shared_client
+    return client.pool_stats() if client is not None else None
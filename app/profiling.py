@@ -0,0 +1,280 @@
+"""
+This module provides an opt-in sampling profiler for production.
+
+With PROFILER_ENABLED, every request and scheduler job run is timed per
+endpoint, and a background thread looks at the stacks of the running ones
+(sys._current_frames) at a coarse interval:
+
+- a request or job running longer than PROFILER_SLOW_MS gets its call stack
+  captured, and is sampled until it finishes;
+- an admin can start a sampling window (/admin/profiler) during which every
+  request and job is sampled at PROFILER_INTERVAL_MS.
+
+Samples are counted per endpoint and frame, so the admin page shows the slowest
+endpoints with their hottest frames. Statistics are kept per process.
+"""
+import os
+import re
+import sys
+import time
+import functools
+import threading
+import traceback
+from collections import Counter, deque
+from flask import Blueprint, render_template, request, redirect, url_for, current_app, abort, g
+from flask_login import login_required, current_user
+from flask_wtf import FlaskForm
+from wtforms import IntegerField, SubmitField
+from wtforms.validators import Optional, NumberRange
+from flask_babel import lazy_gettext as _l
+
+profiler_bp = Blueprint('profiler', __name__, url_prefix='/admin/profiler')
+
+# Interval of the watchdog when no sampling window is active
+WATCHDOG_INTERVAL = 0.1
+# Frames kept per captured stack
+MAX_STACK_DEPTH = 40
+# Slow stacks kept per endpoint
+MAX_SLOW_CAPTURES = 5
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def frame_label(filename, lineno, name):
+    """Short 'file:line function' label, relative to the project for our own code"""
+    if filename.startswith(APP_DIR):
+        filename = os.path.join('app', os.path.relpath(filename, APP_DIR))
+    else:
+        filename = os.path.basename(filename)
+    return f'{filename}:{lineno} {name}'
+
+
+class EndpointStats:
+    """Timings and samples of one endpoint (or scheduler job)"""
+
+    def __init__(self, name):
+        self.name = name
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow_count = 0
+        self.samples = 0
+        # Innermost frame of our own code, and actual innermost frame
+        self.app_frames = Counter()
+        self.leaf_frames = Counter()
+        self.slow_captures = deque(maxlen=MAX_SLOW_CAPTURES)
+
+    @property
+    def anchor(self):
+        """HTML id of the endpoint's card, stable whatever the order"""
+        return 'endpoint-' + re.sub(r'[^A-Za-z0-9_-]+', '-', self.name)
+
+    @property
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def hottest(self, counter, limit=10):
+        return [(frame, count, count / self.samples if self.samples else 0) for frame, count in counter.most_common(limit)]
+
+
+class Profiler:
+    """Per-process request timing, slow-request capture and sampling windows"""
+
+    def __init__(self, slow_threshold=1.0, interval=0.01):
+        self.slow_threshold = slow_threshold
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stats = {}
+        # Thread ident -> [endpoint, start time, captured]
+        self._active = {}
+        self._window_ends_at = 0
+        self._thread = None
+
+    @property
+    def window_active(self):
+        return time.monotonic() < self._window_ends_at
+
+    @property
+    def window_remaining(self):
+        return max(0, int(self._window_ends_at - time.monotonic()))
+
+    def start_window(self, duration):
+        """Sample everything that runs for the next `duration` seconds"""
+        self._window_ends_at = time.monotonic() + duration
+        self.ensure_thread()
+
+    def stop_window(self):
+        self._window_ends_at = 0
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def ensure_thread(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+            self._thread.start()
+
+    def begin(self, endpoint):
+        """Mark the current thread as running `endpoint`"""
+        self._active[threading.get_ident()] = [endpoint, time.monotonic(), False]
+
+    def end(self):
+        """Record the duration of what the current thread was running"""
+        entry = self._active.pop(threading.get_ident(), None)
+        if entry is None:
+            return
+        endpoint, started, captured = entry
+        duration = time.monotonic() - started
+        with self._lock:
+            stats = self._get_stats(endpoint)
+            stats.count += 1
+            stats.total += duration
+            stats.max = max(stats.max, duration)
+            if duration >= self.slow_threshold:
+                stats.slow_count += 1
+
+    def _get_stats(self, endpoint):
+        stats = self._stats.get(endpoint)
+        if stats is None:
+            stats = self._stats[endpoint] = EndpointStats(endpoint)
+        return stats
+
+    def _run(self):
+        while True:
+            window = self.window_active
+            time.sleep(self.interval if window else WATCHDOG_INTERVAL)
+            try:
+                self.sample(window)
+            except Exception:
+                # The profiler must never take the process down
+                pass
+
+    def sample(self, window=False):
+        """Look at the running requests and jobs once"""
+        if not self._active:
+            return
+        now = time.monotonic()
+        frames = sys._current_frames()
+
+        for ident, entry in list(self._active.items()):
+            endpoint, started, captured = entry
+            slow = now - started >= self.slow_threshold
+            frame = frames.get(ident)
+            if frame is None or not (window or slow):
+                continue
+
+            stack = traceback.extract_stack(frame, limit=MAX_STACK_DEPTH)
+            with self._lock:
+                stats = self._get_stats(endpoint)
+                stats.samples += 1
+                leaf = stack[-1]
+                stats.leaf_frames[frame_label(leaf.filename, leaf.lineno, leaf.name)] += 1
+                own = next((f for f in reversed(stack) if f.filename.startswith(APP_DIR) and f.filename != __file__), None)
+                if own is not None:
+                    stats.app_frames[frame_label(own.filename, own.lineno, own.name)] += 1
+
+                if slow and not captured:
+                    entry[2] = True
+                    stats.slow_captures.append({
+                        'at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                        'after': now - started,
+                        'stack': [frame_label(f.filename, f.lineno, f.name) for f in stack],
+                    })
+
+    def snapshot(self):
+        """Endpoints, slowest first"""
+        with self._lock:
+            return sorted(self._stats.values(), key=lambda s: s.max, reverse=True)
+
+
+def get_profiler():
+    return current_app.extensions.get('profiler')
+
+
+def before_request():
+    profiler = current_app.extensions['profiler']
+    # Ignore the profiler's own page
+    if request.endpoint and not request.endpoint.startswith('profiler.'):
+        profiler.begin(request.endpoint)
+        g.profiled = True
+
+
+def teardown_request(exc):
+    if g.get('profiled'):
+        current_app.extensions['profiler'].end()
+
+
+def profiled_job(func):
+    """Time a scheduler job (whose first argument is the app) like a request"""
+    @functools.wraps(func)
+    def wrapper(app, *args, **kwargs):
+        profiler = app.extensions.get('profiler')
+        if profiler is None:
+            return func(app, *args, **kwargs)
+        profiler.begin(f'job:{func.__name__}')
+        try:
+            return func(app, *args, **kwargs)
+        finally:
+            profiler.end()
+    return wrapper
+
+
+class WindowForm(FlaskForm):
+    duration = IntegerField(default=60, validators=[Optional(), NumberRange(min=1)])
+    start = SubmitField(_l('Sample every request for this many seconds'))
+    stop = SubmitField(_l('Stop sampling'))
+    reset = SubmitField(_l('Clear statistics'))
+
+
+@profiler_bp.before_request
+@login_required
+def require_admin():
+    if not current_user.is_admin:
+        abort(403)
+
+
+@profiler_bp.route('/')
+def index():
+    """Slowest endpoints and their hottest frames"""
+    profiler = get_profiler()
+    return render_template('profiler.html', profiler=profiler, form=WindowForm(),
+                           endpoints=profiler.snapshot() if profiler else [])
+
+
+@profiler_bp.route('/window', methods=['POST'])
+def window():
+    """Start or stop a sampling window, or clear the statistics"""
+    profiler = get_profiler()
+    if profiler is None:
+        abort(404)
+
+    form = WindowForm()
+    if not form.validate_on_submit():
+        abort(400)
+
+    if form.start.data:
+        duration = min(form.duration.data or 60, current_app.config['PROFILER_MAX_WINDOW'])
+        profiler.start_window(duration)
+        current_app.logger.info(f"Profiler sampling window started for {duration}s by {current_user.username}")
+    elif form.stop.data:
+        profiler.stop_window()
+    elif form.reset.data:
+        profiler.reset()
+    return redirect(url_for('profiler.index'))
+
+
+def init_app(app):
+    """Time requests and start the watchdog if PROFILER_ENABLED"""
+    app.register_blueprint(profiler_bp)
+    if not app.config['PROFILER_ENABLED']:
+        return
+
+    profiler = Profiler(
+        slow_threshold=app.config['PROFILER_SLOW_MS'] / 1000,
+        interval=app.config['PROFILER_INTERVAL_MS'] / 1000,
+    )
+    app.extensions['profiler'] = profiler
+    app.before_request(before_request)
+    app.teardown_request(teardown_request)
+    profiler.ensure_thread()
@@ -1,8 +1,14 @@
-from flask import Blueprint, render_template, redirect, url_for, current_app, request, session, make_response
+from flask import Blueprint, render_template, redirect, url_for, current_app, request, session, make_response, abort
 from flask_login import login_required, current_user
 import os
 import json
 from datetime import datetime, timedelta
+from app.archive import load_transactions as load_archived_transactions, to_minor_units, transaction_date
+from app.archive import monthly_sums as archived_monthly_sums
+from app.analysis import get_anomalies
+from app.consistency import get_issues as get_consistency_issues
+from app.transfers import get_internal_keys, get_internal_legs, leg_key
+from app import db
 
 main = Blueprint('main', __name__)
 
@@ -12,9 +18,8 @@ def index():
     # Add debug information about the current language
     from flask_babel import get_locale
     current_lang = str(get_locale())
-    print(f"Current language from Babel: {current_lang}")
-    print(f"Language in session: {session.get('language', 'Not set')}")
-    print(f"Language in cookie: {request.cookies.get('user_language', 'Not set')}")
+    current_app.logger.debug(f"Current language from Babel: {current_lang}, "
+                             f"cookie: {request.cookies.get('user_language', 'Not set')}")
     
     return render_template('index.html', debug_lang=current_lang)
 
@@ -29,10 +34,11 @@ def set_language(language):
     
     # Check if the language is supported
     if language in current_app.config['LANGUAGES']:
-        # Set language in session (for current session)
-        session['language'] = language
+        # Forget a language stored in the session by older versions
+        if 'language' in session:
+            session.pop('language')
         
-        # Also set a persistent cookie that will last for 365 days
+        # Set a persistent cookie that will last for 365 days
         expires = datetime.now() + timedelta(days=365)
         response.set_cookie('user_language', language, expires=expires)
     
@@ -56,54 +62,153 @@ def dashboard():
         except:
             pass
     
-    return render_template('dashboard.html', accounts=accounts_data)
+    anomalies = get_anomalies(current_app.instance_path, current_user.id)
+    consistency_issues = get_consistency_issues(current_app.instance_path, current_user.id)
+    
+    return render_template('dashboard.html', accounts=accounts_data, anomalies=anomalies[:20],
+                           consistency_issues=consistency_issues)
 
-@main.route('/transparency')
-def transparency():
-    """Public account transparency page"""
-    # Check if user is logged in to get their specific data
-    if current_user.is_authenticated:
-        # Get logged-in user's account data
-        data_file = os.path.join(
-            current_app.instance_path, 
-            f'account_data_{current_user.id}.json'
-        )
-    else:
-        # For public view, get admin's account data (ID 1)
+def load_organisation_accounts(organisation):
+    """Accounts of an organisation with their full history (hot store and archive)"""
+    # An organisation's accounts are the accounts connected by its members
+    user_ids = db.get_organisation_user_ids(organisation['id']) if organisation else []
+    # Transfers between the organisation's own accounts, matched at ingest
+    internal_keys = get_internal_keys(current_app.instance_path, organisation['id']) if organisation else frozenset()
+    
+    accounts = []
+    for user_id in user_ids:
         data_file = os.path.join(
             current_app.instance_path, 
-            'account_data_1.json'  # Using the admin account (ID 1) data for public view
+            f'account_data_{user_id}.json'
         )
-    
-    accounts_data = []
-    transactions = []
-    total_balance = 0
-    number_of_accounts = 0
-    if os.path.exists(data_file):
+        if not os.path.exists(data_file):
+            continue
         try:
             with open(data_file, 'r') as f:
                 accounts_data = json.load(f)
             
-            # Extract transactions from all accounts
             for account in accounts_data:
-                number_of_accounts += 1
-                if 'balances' in account:
-                    print(f"Account: {account.get('balances', [{}])}")
-                    balance = account.get('balances', [{}])[0].get('balanceAmount', {}).get('amount', 0)
-                    print(f"Balance: {balance}")
-                    total_balance += float(balance) if isinstance(balance, str) else balance
                 if 'transactions' in account:
-                    # Associate transactions with their account
-                    for category in ['booked', 'pending']:
-                        if category in account.get('transactions', {}):
-                            for tx in account['transactions'][category]:
-                                tx['account_name'] = account.get('name', 'Unknown account')
-                                tx['account_id'] = account.get('id')
-                                tx['status'] = category
-                                transactions.append(tx)
+                    # Closed months live in the archive, not in the hot store
+                    archived = load_archived_transactions(
+                        current_app.instance_path, user_id, account_id=account.get('id')
+                    )
+                    account['transactions'].setdefault('booked', []).extend(archived)
+                    if internal_keys:
+                        for tx in account['transactions']['booked']:
+                            if leg_key(account.get('id'), tx) in internal_keys:
+                                tx['internalTransfer'] = True
+                accounts.append(account)
         except Exception as e:
             current_app.logger.error(f"Error retrieving transactions: {str(e)}")
     
+    return accounts
+
+def load_organisation_sums(organisation, account_id=None, start=None, end=None, exclude_internal=True):
+    """
+    Booked income and expenses (cents) of an organisation per (month, currency).
+
+    Closed months come from the sums the archive index keeps per partition,
+    only the hot store is scanned. With exclude_internal, transfers between
+    the organisation's own accounts are left out.
+    """
+    user_ids = db.get_organisation_user_ids(organisation['id']) if organisation else []
+    legs = get_internal_legs(current_app.instance_path, organisation['id']) if organisation and exclude_internal else {}
+    # Legs recorded without an amount can only be taken out by reading the records
+    exact = all(leg is not None for leg in legs.values())
+    start_str = start.isoformat() if start else None
+    end_str = end.isoformat() if end else None
+    months = {}
+
+    def add(month, currency, count, income, expenses):
+        values = months.setdefault((month, currency), {'count': 0, 'income': 0, 'expenses': 0})
+        values['count'] += count
+        values['income'] += income
+        values['expenses'] += expenses
+
+    def add_transaction(tx, currency, sign=1):
+        tx_date = transaction_date(tx)
+        if not tx_date or (start_str and tx_date < start_str) or (end_str and tx_date > end_str):
+            return
+        cents = to_minor_units(tx.get('transactionAmount', {}).get('amount', 0))
+        add(tx_date[:7], currency, sign, sign * max(cents, 0), sign * min(cents, 0))
+
+    for user_id in user_ids:
+        data_file = os.path.join(current_app.instance_path, f'account_data_{user_id}.json')
+        accounts_data = []
+        if os.path.exists(data_file):
+            try:
+                with open(data_file, 'r') as f:
+                    accounts_data = json.load(f)
+            except json.JSONDecodeError:
+                current_app.logger.error(f"Error parsing account data for user {user_id}")
+
+        # Archived partitions of deleted accounts are not part of the totals
+        current_accounts = {account.get('id') for account in accounts_data}
+        hot_keys = set()
+        for account in accounts_data:
+            if account_id and account.get('id') != account_id:
+                continue
+            for tx in account.get('transactions', {}).get('booked', []):
+                key = leg_key(account.get('id'), tx)
+                hot_keys.add(key)
+                if key not in legs:
+                    currency = tx.get('transactionAmount', {}).get('currency') or account.get('currency', 'EUR')
+                    add_transaction(tx, currency)
+
+        if not exact:
+            for tx in load_archived_transactions(current_app.instance_path, user_id, account_id=account_id,
+                                                 start=start, end=end):
+                if tx['account_id'] in current_accounts and leg_key(tx['account_id'], tx) not in legs:
+                    currency = tx.get('transactionAmount', {}).get('currency') or 'EUR'
+                    add_transaction(tx, currency)
+            continue
+
+        archived = archived_monthly_sums(current_app.instance_path, user_id, account_id=account_id, start=start, end=end)
+        archived = {key: values for key, values in archived.items() if key[0] in current_accounts}
+        for (archived_account, month, currency), values in archived.items():
+            add(month, currency, values['count'], values['inflow_cents'], values['outflow_cents'])
+
+        # Internal legs rolled into the archive are part of the partition sums
+        partition_currency = {(a, month): currency for a, month, currency in archived}
+        for key, (leg_date, cents) in legs.items():
+            leg_account = key.split('|', 1)[0]
+            currency = partition_currency.get((leg_account, leg_date[:7]))
+            if currency is None or key in hot_keys:
+                continue
+            add_transaction({'bookingDate': leg_date, 'transactionAmount': {'amount': f'{cents / 100:.2f}'}}, currency, -1)
+
+    return months
+
+def load_transparency_data(organisation):
+    """Balances and transactions of an organisation, as shown on its transparency page"""
+    transactions = []
+    total_balance = 0
+    number_of_accounts = 0
+    currencies = set()
+    
+    # Extract transactions from all accounts
+    for account in load_organisation_accounts(organisation):
+        number_of_accounts += 1
+        currencies.add(account.get('currency', 'EUR'))
+        if 'balances' in account:
+            balance = account.get('balances', [{}])[0].get('balanceAmount', {}).get('amount', 0)
+            total_balance += float(balance) if isinstance(balance, str) else balance
+        if 'transactions' in account:
+            # Associate transactions with their account
+            for category in ['booked', 'pending']:
+                if category in account.get('transactions', {}):
+                    for tx in account['transactions'][category]:
+                        tx['account_name'] = account.get('name', 'Unknown account')
+                        tx['account_id'] = account.get('id')
+                        tx['status'] = category
+                        transactions.append(tx)
+    
+    # Money moved between own accounts is neither income nor expense
+    sums = load_organisation_sums(organisation).values()
+    total_income = sum(values['income'] for values in sums)
+    total_expenses = sum(values['expenses'] for values in sums)
+    
     # Sort transactions by date safely
     try:
         transactions.sort(
@@ -117,8 +222,35 @@ def transparency():
         current_app.logger.error(f"Error sorting transactions: {str(e)}")
         # If sorting fails, at least we have unsorted transactions
 
+    return {
+        'total_balance': total_balance,
+        'total_income': round(total_income / 100, 2),
+        'total_expenses': round(total_expenses / 100, 2),
+        # Totals are only labelled with a currency when all accounts share it
+        'currency': currencies.pop() if len(currencies) == 1 else '',
+        'transactions': transactions,
+        'number_of_accounts': number_of_accounts,
+    }
+
+@main.route('/transparency')
+@main.route('/transparency/<organisation_slug>')
+def transparency(organisation_slug=None):
+    """Public account transparency page"""
+    if organisation_slug:
+        organisation = db.get_organisation_by_slug(organisation_slug)
+        # Private organisations are only visible to their own members
+        if organisation is None or not (organisation['is_public'] or (
+                current_user.is_authenticated and current_user.organisation_id == organisation['id'])):
+            abort(404)
+    elif current_user.is_authenticated and current_user.organisation_id:
+        # Logged-in treasurers see their own organisation
+        organisation = db.get_organisation(current_user.organisation_id)
+    else:
+        # For public view, use the default public organisation
+        organisation = db.get_default_organisation()
+
+    data = load_transparency_data(organisation)
 
     return render_template('transparency.html', 
-                         total_balance=total_balance, 
-                         transactions=transactions, 
-                         number_of_accounts=number_of_accounts)
\ No newline at end of file
+                         organisation=organisation,
+                         **data)
\ No newline at end of file
@@ -4,10 +4,13 @@ This module handles background scheduled tasks for the application.
 import os
 import json
 from flask import current_app
-from app.nordigen_api import get_client
+from app.nordigen_api import get_client, save_account_data_to_file
+from app.profiling import profiled_job
+from app.sync import SyncPipeline, format_stages, stored_targets
 import time
 # from sqlalchemy.orm.exc import DetachedInstanceError
 
+@profiled_job
 def refresh_all_accounts_job(app):
     """
     Background job to refresh all user accounts from Nordigen API.
@@ -21,104 +24,74 @@ def refresh_all_accounts_job(app):
             # Initialize Nordigen client
             client = get_client()
             
-            # Get all users who have account data
-            instance_path = current_app.instance_path
-            user_files = {}
-            
-            # Find all user-related files in the instance directory
-            for filename in os.listdir(instance_path):
-                if filename.startswith('account_data_') and filename.endswith('.json'):
-                    # Extract user_id from filename (account_data_1.json -> 1)
-                    try:
-                        user_id = int(filename.replace('account_data_', '').replace('.json', ''))
-                        if user_id not in user_files:
-                            user_files[user_id] = []
-                        user_files[user_id].append(filename)
-                    except ValueError:
-                        continue
-            
-            # Process each user's accounts
-            total_users = len(user_files)
-            users_processed = 0
-            accounts_updated = 0
-            
-            for user_id, files in user_files.items():
-                try:
-                    current_app.logger.info(f"Processing accounts for user {user_id}")
-                    
-                    # Get requisition map if available
-                    requisition_map = {}
-                    req_map_file = os.path.join(instance_path, f'requisition_map_{user_id}.json')
-                    if os.path.exists(req_map_file):
-                        try:
-                            with open(req_map_file, 'r') as f:
-                                requisition_map = json.load(f)
-                        except json.JSONDecodeError:
-                            current_app.logger.error(f"Error parsing requisition map for user {user_id}")
-                    
-                    # Get account data file
-                    data_file = os.path.join(instance_path, f'account_data_{user_id}.json')
-                    if not os.path.exists(data_file):
-                        continue
-                    
-                    try:
-                        with open(data_file, 'r') as f:
-                            accounts_data = json.load(f)
-                    except json.JSONDecodeError:
-                        current_app.logger.error(f"Error parsing account data for user {user_id}")
-                        continue
-                    
-                    # Update each account for this user
-                    updated_accounts = []
-                    
-                    for account in accounts_data:
-                        account_id = account.get('id')
-                        if not account_id:
-                            continue
-                            
-                        try:
-                            # Get updated account information directly from API
-                            account_api = client.account_api(account_id)
-                            account_details = account_api.get_details()
-                            account_balances = account_api.get_balances()
-                            account_transactions = account_api.get_transactions()
-                            
-                            # Create updated account object from fresh API data
-                            updated_account = {
-                                'id': account_id,
-                                'name': account_details.get('account', {}).get('name', 'Unnamed account'),
-                                'iban': account_details.get('account', {}).get('iban', 'IBAN not available'),
-                                'currency': account_details.get('account', {}).get('currency', 'EUR'),
-                                'balances': account_balances.get('balances', []),
-                                'transactions': account_transactions.get('transactions', {'booked': [], 'pending': []})
-                            }
-                            
-                            # Ensure required keys exist for transactions
-                            if 'booked' not in updated_account['transactions']:
-                                updated_account['transactions']['booked'] = []
-                            if 'pending' not in updated_account['transactions']:
-                                updated_account['transactions']['pending'] = []
-                            
-                            updated_accounts.append(updated_account)
-                            accounts_updated += 1
-                            
-                        except Exception as e:
-                            current_app.logger.error(f"Error refreshing account {account_id}: {str(e)}")
-                    
-                    # Save updated account data back to file
-                    if updated_accounts:
-                        with open(data_file, 'w') as f:
-                            json.dump(updated_accounts, f, indent=4)
-                        current_app.logger.info(f"Updated {len(updated_accounts)} accounts for user {user_id}")
-                    
-                    users_processed += 1
-                    
-                except Exception as e:
-                    current_app.logger.error(f"Error processing user {user_id}: {str(e)}")
+            # Sync the stored accounts of every user, in batches; users whose
+            # data changed are saved and the static pages re-exported
+            targets = stored_targets(current_app.instance_path)
+            report = SyncPipeline(app, client).run(targets)
             
             current_app.logger.info(f"Completed scheduled refresh: "
-                                f"processed {users_processed}/{total_users} users, "
-                                f"updated {accounts_updated} accounts.")
+                                f"{report['users_changed']}/{report['users']} users changed, "
+                                f"updated {report['accounts_fetched']} accounts "
+                                f"({report['accounts_failed']} failed), "
+                                f"{report['new_transactions']} new transactions. "
+                                f"Stages: {format_stages(report['stages'])}")
                     
         except Exception as e:
             current_app.logger.error(f"Error in scheduled account refresh job: {str(e)}")
+
+@profiled_job
+def refetch_window_job(app, user_id, account_id, date_from, date_to):
+    """
+    One-off job refetching the transactions of an account in a date window
+    whose stored history does not add up to the reported balances.
+    """
+    from app.consistency import merge_transactions, refetch_done, schedule_refetches
+    
+    with app.app_context():
+        try:
+            current_app.logger.info(f"Refetching transactions of account {account_id} "
+                                    f"from {date_from} to {date_to} for user {user_id}")
+            
+            data_file = os.path.join(current_app.instance_path, f'account_data_{user_id}.json')
+            if not os.path.exists(data_file):
+                return
+            with open(data_file, 'r') as f:
+                accounts_data = json.load(f)
+            
+            account = next((acc for acc in accounts_data if acc.get('id') == account_id), None)
+            if account is None:
+                current_app.logger.info(f"Account {account_id} was removed, nothing to refetch")
+                return
+            
+            client = get_client()
+            fetched = client.account_api(account_id).get_transactions(date_from=date_from, date_to=date_to)
+            added = merge_transactions(account, fetched)
+            current_app.logger.info(f"Refetch added {added} transactions to account {account_id}")
+            
+            # Saving checks the account again
+            save_account_data_to_file(accounts_data, user_id)
+            
+        except Exception as e:
+            current_app.logger.error(f"Error refetching account {account_id}: {str(e)}")
+        finally:
+            # Retried (up to a limit) if the window still doesn't add up
+            refetch_done(current_app.instance_path, user_id, account_id, date_from, date_to)
+            schedule_refetches(app, user_id)
+
+
+@profiled_job
+def instance_maintenance_job(app):
+    """
+    Weekly job pruning orphaned and expired data and compacting the stored history.
+    """
+    from app.maintenance import run_maintenance
+    
+    with app.app_context():
+        try:
+            report = run_maintenance(app)
+            reclaimed = sum(entry['reclaimed'] for entry in report['users'].values())
+            current_app.logger.info(f"Instance maintenance: {reclaimed} bytes reclaimed for "
+                                    f"{len(report['users'])} users, "
+                                    f"{report['database_reclaimed']} bytes from the database")
+        except Exception as e:
+            current_app.logger.error(f"Error in instance maintenance job: {str(e)}")
@@ -0,0 +1,358 @@
+"""
+This module provides the sync pipeline for bank account data.
+
+A sync runs in explicit stages, each over a whole batch of users:
+
+    fetch      raw details, balances and transactions of every account
+    normalize  into the account objects stored in account_data_<user_id>.json
+    diff       against the stored accounts (hot store and archive)
+    publish    write the changed users (analysis, consistency checks, internal
+               transfers and archiving run on write), drop the API caches of
+               their organisations, and re-export the static pages at the end
+
+There is no separate aggregate store to update when publishing: the sums of
+closed months are written with their archive partitions, and totals are
+built from those and the hot store when read (see load_organisation_sums).
+
+Every stage runs its items on its own thread pool, and users are processed
+SYNC_BATCH_SIZE at a time so memory stays bounded however many organisations
+are synced. Users whose data did not change are not written at all. The
+duration of each stage is reported in the sync report.
+"""
+import os
+import json
+import time
+import threading
+from collections import Counter
+from contextlib import contextmanager
+from datetime import date
+import click
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from app import db
+from app.archive import transaction_date, transaction_key
+from app.archive import load_transactions as load_archived_transactions
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, writes are then only serialized within a process
+    fcntl = None
+
+_user_locks = {}
+_user_locks_lock = threading.Lock()
+
+
+@contextmanager
+def user_lock(instance_path, user_id):
+    """Serialize writes to a user's files between syncs and maintenance, across processes"""
+    if fcntl is None:
+        with _user_locks_lock:
+            lock = _user_locks.setdefault(user_id, threading.Lock())
+        with lock:
+            yield
+        return
+
+    lock_dir = os.path.join(instance_path, 'locks')
+    os.makedirs(lock_dir, exist_ok=True)
+    with open(os.path.join(lock_dir, f'user_{user_id}.lock'), 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def fetch_account(client, account_id):
+    """Raw API payloads of an account"""
+    account_api = client.account_api(account_id)
+    return {
+        'id': account_id,
+        'details': account_api.get_details(),
+        'balances': account_api.get_balances(),
+        'transactions': account_api.get_transactions(),
+    }
+
+
+def normalize_account(account_id, details, balances, transactions):
+    """Create the account object stored in account_data_<user_id>.json"""
+    account = {
+        'id': account_id,
+        'name': details.get('account', {}).get('name', 'Unnamed account'),
+        'iban': details.get('account', {}).get('iban', 'IBAN not available'),
+        'currency': details.get('account', {}).get('currency', 'EUR'),
+        'balances': balances.get('balances', []),
+        'transactions': transactions.get('transactions', {'booked': [], 'pending': []})
+    }
+
+    # Ensure required keys exist for transactions
+    account['transactions'].setdefault('booked', [])
+    account['transactions'].setdefault('pending', [])
+    return account
+
+
+def load_stored_accounts(instance_path, user_id):
+    data_file = os.path.join(instance_path, f'account_data_{user_id}.json')
+    if not os.path.exists(data_file):
+        return []
+    try:
+        with open(data_file, 'r') as f:
+            return json.load(f)
+    except json.JSONDecodeError:
+        return []
+
+
+def keep_stored_transactions(stored_accounts, accounts):
+    """Add back the stored booked transactions the API no longer returns"""
+    # The API only returns a window of recent transactions: rows older than that
+    # are only in the hot store (e.g. late rows of already archived months)
+    stored = {a.get('id'): a for a in stored_accounts}
+    for account in accounts:
+        previous = stored.get(account.get('id'))
+        if previous is None or previous is account:
+            continue
+        booked = account.setdefault('transactions', {}).setdefault('booked', [])
+        fetched = Counter(transaction_key(tx) for tx in booked)
+        for tx in previous.get('transactions', {}).get('booked', []):
+            key = transaction_key(tx)
+            if fetched[key]:
+                fetched[key] -= 1
+            else:
+                booked.append(tx)
+    return accounts
+
+
+def diff_account(instance_path, user_id, stored, fetched):
+    """What changed in an account since it was stored"""
+    fetched_booked = {transaction_key(tx): tx for tx in fetched['transactions']['booked']}
+    fetched_pending = {transaction_key(tx) for tx in fetched['transactions']['pending']}
+    if stored is None:
+        return {'changed': True, 'new_transactions': len(fetched_booked)}
+
+    stored_transactions = stored.get('transactions', {})
+    new_booked = set(fetched_booked) - {transaction_key(tx) for tx in stored_transactions.get('booked', [])}
+    if new_booked:
+        # Closed months are no longer in the hot store, look them up in the archive
+        dates = [transaction_date(fetched_booked[key]) for key in new_booked if transaction_date(fetched_booked[key])]
+        if dates:
+            archived = load_archived_transactions(instance_path, user_id, account_id=fetched['id'],
+                                                  start=date.fromisoformat(min(dates)),
+                                                  end=date.fromisoformat(max(dates)))
+            new_booked -= {transaction_key(tx) for tx in archived}
+
+    stored_pending = {transaction_key(tx) for tx in stored_transactions.get('pending', [])}
+    changed = bool(new_booked or fetched_pending != stored_pending or
+                   any(stored.get(field) != fetched.get(field) for field in ('name', 'iban', 'currency', 'balances')))
+    return {'changed': changed, 'new_transactions': len(new_booked)}
+
+
+class SyncTarget:
+    """Accounts of one user to sync"""
+
+    def __init__(self, user_id, account_ids):
+        self.user_id = user_id
+        self.account_ids = list(dict.fromkeys(account_ids))
+
+
+class SyncPipeline:
+    """Staged, batched sync of many users' accounts (the client is only used by run)"""
+
+    def __init__(self, app, client=None, fetch_workers=None, publish_workers=None, batch_size=None):
+        self.app = app
+        self.client = client
+        self.fetch_workers = fetch_workers or app.config['SYNC_FETCH_WORKERS']
+        self.publish_workers = publish_workers or app.config['SYNC_PUBLISH_WORKERS']
+        self.batch_size = batch_size or app.config['SYNC_BATCH_SIZE']
+        self.stages = {}
+
+    def _stage(self, name, func, items, workers):
+        """Run a stage over a batch, return (item, result, error) tuples"""
+        def call(item):
+            try:
+                return item, func(item), None
+            except Exception as e:
+                return item, None, e
+
+        started = time.perf_counter()
+        if workers > 1 and len(items) > 1:
+            with ThreadPoolExecutor(max_workers=min(workers, len(items)), thread_name_prefix=f'sync-{name}') as pool:
+                results = list(pool.map(call, items))
+        else:
+            results = [call(item) for item in items]
+
+        stats = self.stages.setdefault(name, {'seconds': 0.0, 'items': 0, 'errors': 0, 'batches': 0})
+        stats['seconds'] += time.perf_counter() - started
+        stats['items'] += len(items)
+        stats['errors'] += sum(1 for _, _, error in results if error is not None)
+        stats['batches'] += 1
+        return results
+
+    def _diff_user(self, work):
+        target, accounts = work
+        stored = {a.get('id'): a for a in load_stored_accounts(self.app.instance_path, target.user_id)}
+
+        result = []
+        changed = False
+        new_transactions = 0
+        for account_id in target.account_ids:
+            fetched = accounts.get(account_id)
+            if fetched is None:
+                # Fetch failed: keep what we have instead of dropping the account
+                if account_id in stored:
+                    result.append(stored[account_id])
+                continue
+            diff = diff_account(self.app.instance_path, target.user_id, stored.get(account_id), fetched)
+            changed = changed or diff['changed']
+            new_transactions += diff['new_transactions']
+            result.append(fetched)
+
+        # Accounts no longer part of the user's connections
+        changed = changed or bool(set(stored) - {a.get('id') for a in result})
+        return {'accounts': result, 'changed': changed, 'new_transactions': new_transactions}
+
+    def _publish_user(self, work):
+        from app.nordigen_api import save_account_data_to_file
+        from app.api import invalidate_dataset
+
+        target, accounts = work
+        with self.app.app_context():
+            save_account_data_to_file(accounts, target.user_id)
+            user = db.get_user_row(target.user_id)
+            if user is not None and user['organisation_id']:
+                invalidate_dataset(user['organisation_id'])
+
+    def _export(self):
+        """Export the static pages, when configured"""
+        if not self.app.config.get('TRANSPARENCY_EXPORT_DIR'):
+            return
+        from app.export import export_transparency
+        exported = self._stage('export', lambda _: export_transparency(self.app), [None], 1)
+        for _, result, error in exported:
+            if error is not None:
+                self.app.logger.error(f"Error exporting transparency pages: {str(error)}")
+            else:
+                self.app.logger.info(f"Exported {len(result[1])} transparency pages to {result[0]}")
+
+    def publish(self, target, accounts):
+        """Compare and store accounts fetched elsewhere (by the async client), return the diff"""
+        diff = self._diff_user((target, accounts))
+        if diff['changed']:
+            self._publish_user((target, diff['accounts']))
+            self._export()
+        return diff
+
+    def run(self, targets):
+        """Sync the targets batch by batch, return a report"""
+        report = {
+            'users': len(targets), 'users_changed': 0, 'accounts_fetched': 0, 'accounts_failed': 0,
+            'new_transactions': 0, 'stages': self.stages,
+        }
+
+        for start in range(0, len(targets), self.batch_size):
+            batch = targets[start:start + self.batch_size]
+
+            fetch_items = [(target.user_id, account_id) for target in batch for account_id in target.account_ids]
+            fetched = self._stage('fetch', lambda item: fetch_account(self.client, item[1]),
+                                  fetch_items, self.fetch_workers)
+            raw = []
+            for (user_id, account_id), payload, error in fetched:
+                if error is not None:
+                    self.app.logger.error(f"Error refreshing account {account_id}: {str(error)}")
+                    report['accounts_failed'] += 1
+                else:
+                    raw.append((user_id, payload))
+            report['accounts_fetched'] += len(raw)
+            del fetched
+
+            normalized = self._stage(
+                'normalize',
+                lambda item: normalize_account(item[1]['id'], item[1]['details'], item[1]['balances'],
+                                               item[1]['transactions']),
+                raw, 1
+            )
+            del raw
+            by_user = {target.user_id: {} for target in batch}
+            for (user_id, _), account, error in normalized:
+                if error is None:
+                    by_user[user_id][account['id']] = account
+            del normalized
+
+            diffs = self._stage('diff', self._diff_user,
+                                [(target, by_user[target.user_id]) for target in batch], self.publish_workers)
+            del by_user
+
+            to_publish = []
+            for (target, _), diff, error in diffs:
+                if error is not None:
+                    self.app.logger.error(f"Error comparing accounts of user {target.user_id}: {str(error)}")
+                    continue
+                report['new_transactions'] += diff['new_transactions']
+                if diff['changed']:
+                    to_publish.append((target, diff['accounts']))
+            del diffs
+
+            published = self._stage('publish', self._publish_user, to_publish, self.publish_workers)
+            for (target, _), _, error in published:
+                if error is not None:
+                    self.app.logger.error(f"Error saving accounts of user {target.user_id}: {str(error)}")
+                else:
+                    report['users_changed'] += 1
+
+        # Static pages only need a new export if something changed
+        if report['users_changed']:
+            self._export()
+
+        return report
+
+
+def format_stages(stages):
+    """One line per stage: time, items and errors"""
+    return '; '.join(
+        f"{name} {stats['seconds']:.2f}s/{stats['items']} items"
+        + (f"/{stats['errors']} errors" if stats['errors'] else '')
+        for name, stats in stages.items()
+    )
+
+
+def stored_targets(instance_path, user_ids=None):
+    """Sync targets for the accounts already stored for each user"""
+    targets = []
+    for filename in sorted(os.listdir(instance_path)):
+        if not (filename.startswith('account_data_') and filename.endswith('.json')):
+            continue
+        try:
+            user_id = int(filename.replace('account_data_', '').replace('.json', ''))
+        except ValueError:
+            continue
+        if user_ids is not None and user_id not in user_ids:
+            continue
+        account_ids = [a.get('id') for a in load_stored_accounts(instance_path, user_id) if a.get('id')]
+        if account_ids:
+            targets.append(SyncTarget(user_id, account_ids))
+    return targets
+
+
+@click.command('sync-accounts')
+@click.option('--organisation', 'organisation_slug', default=None, help='Only sync the accounts of this organisation.')
+def sync_accounts_command(organisation_slug):
+    """Refresh the stored accounts of every user from the bank API."""
+    from app.nordigen_api import get_client
+
+    user_ids = None
+    if organisation_slug:
+        organisation = db.get_organisation_by_slug(organisation_slug)
+        if organisation is None:
+            raise click.ClickException(f"Unknown organisation '{organisation_slug}'")
+        user_ids = set(db.get_organisation_user_ids(organisation['id']))
+
+    app = current_app._get_current_object()
+    pipeline = SyncPipeline(app, get_client())
+    report = pipeline.run(stored_targets(app.instance_path, user_ids))
+    click.echo(f"Synced {report['accounts_fetched']} accounts ({report['accounts_failed']} failed) of "
+               f"{report['users']} users, {report['users_changed']} changed, "
+               f"{report['new_transactions']} new transactions")
+    click.echo(format_stages(report['stages']))
+
+
+def init_app(app):
+    app.cli.add_command(sync_accounts_command)
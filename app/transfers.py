@@ -0,0 +1,235 @@
+"""
+This module detects internal transfers between an organisation's own accounts.
+
+Money moved from one of the organisation's accounts to another shows up twice,
+as an expense on one account and as an income on the other. At ingest, the
+outgoing and incoming legs are paired with a hash join on (amount, IBAN),
+then filtered on a date window:
+
+    outflow of account A, creditor IBAN = IBAN of B  <->  inflow of account B
+    outflow of account A                              <->  inflow of B, debtor IBAN = IBAN of A
+
+Paired (and single legs whose counterparty is one of the organisation's IBANs)
+are recorded in instance/internal_transfers_<organisation_id>.json, which the
+readers consult to leave them out of totals without matching again. The date
+and amount of each leg are recorded too, so totals built from the archive's
+per-month sums can take out the legs that were archived.
+"""
+import os
+import re
+import json
+import threading
+from datetime import date
+from app import db
+from app.archive import transaction_date, transaction_key, to_minor_units
+
+# Days between the two legs of a transfer (banks book them on different days)
+TRANSFER_WINDOW_DAYS = 3
+
+IBAN_PATTERN = re.compile(r'^[A-Z]{2}[0-9]{2}[A-Z0-9]{8,30}$')
+
+_index_lock = threading.Lock()
+# Loaded indexes, keyed by organisation ID, kept while the file is unchanged
+_index_cache = {}
+
+
+def _index_path(instance_path, organisation_id):
+    return os.path.join(instance_path, f'internal_transfers_{organisation_id}.json')
+
+
+def normalize_iban(iban):
+    """IBAN without spaces, or '' for placeholders like 'IBAN not available'"""
+    iban = (iban or '').replace(' ', '').upper()
+    return iban if IBAN_PATTERN.match(iban) else ''
+
+
+def leg_key(account_id, tx):
+    """Identity of a transaction within an organisation"""
+    return f'{account_id}|{transaction_key(tx)}'
+
+
+def load_index(instance_path, organisation_id):
+    """Internal transfers recorded for an organisation"""
+    index_path = _index_path(instance_path, organisation_id)
+    if os.path.exists(index_path):
+        try:
+            with open(index_path, 'r') as f:
+                return json.load(f)
+        except json.JSONDecodeError:
+            pass
+    return {'pairs': [], 'legs': []}
+
+
+def _get_cached_index(instance_path, organisation_id):
+    """(keys, amounts) of the recorded legs, cached while the file is unchanged"""
+    index_path = _index_path(instance_path, organisation_id)
+    try:
+        mtime = os.stat(index_path).st_mtime_ns
+    except OSError:
+        return frozenset(), {}
+
+    cached = _index_cache.get(organisation_id)
+    if cached and cached[0] == (index_path, mtime):
+        return cached[1]
+    index = load_index(instance_path, organisation_id)
+    legs = (frozenset(index['legs']), index.get('amounts', {}))
+    _index_cache[organisation_id] = ((index_path, mtime), legs)
+    return legs
+
+
+def get_internal_keys(instance_path, organisation_id):
+    """Keys (see leg_key) of all internal transfer legs of an organisation"""
+    return _get_cached_index(instance_path, organisation_id)[0]
+
+
+def get_internal_legs(instance_path, organisation_id):
+    """
+    Internal transfer legs of an organisation as {key: (date, cents)}; legs
+    recorded before amounts were kept have None instead
+    """
+    keys, amounts = _get_cached_index(instance_path, organisation_id)
+    return {key: tuple(amounts[key]) if key in amounts else None for key in keys}
+
+
+def _counterparty_iban(tx, field):
+    return normalize_iban((tx.get(field) or {}).get('iban'))
+
+
+def match_transfers(accounts):
+    """
+    Pair the internal transfers between accounts.
+
+    Returns (pairs, legs): pairs as (outgoing key, incoming key, amount, date)
+    tuples, and every internal leg, paired or not, as {key: [date, cents]}.
+    """
+    own_ibans = {normalize_iban(a.get('iban')): a.get('id') for a in accounts if normalize_iban(a.get('iban'))}
+
+    outflows = []
+    by_receiver = {}
+    by_sender = {}
+    legs = {}
+    for account in accounts:
+        account_id = account.get('id')
+        account_iban = normalize_iban(account.get('iban'))
+        for tx in account.get('transactions', {}).get('booked', []):
+            tx_date = transaction_date(tx)
+            cents = to_minor_units(tx.get('transactionAmount', {}).get('amount', 0))
+            if not tx_date or cents == 0:
+                continue
+            leg = (leg_key(account_id, tx), date.fromisoformat(tx_date).toordinal(), account_iban, tx)
+            if cents < 0:
+                creditor = _counterparty_iban(tx, 'creditorAccount')
+                if creditor in own_ibans and own_ibans[creditor] != account_id:
+                    legs[leg[0]] = [tx_date, cents]
+                outflows.append((-cents, creditor, leg))
+            else:
+                debtor = _counterparty_iban(tx, 'debtorAccount')
+                if debtor in own_ibans and own_ibans[debtor] != account_id:
+                    legs[leg[0]] = [tx_date, cents]
+                by_receiver.setdefault((cents, account_iban), []).append(leg)
+                if debtor:
+                    by_sender.setdefault((cents, debtor), []).append(leg)
+
+    pairs = []
+    matched = set()
+    for cents, creditor, (key, day, account_iban, tx) in outflows:
+        candidates = []
+        if creditor in own_ibans:
+            candidates += by_receiver.get((cents, creditor), [])
+        if account_iban:
+            candidates += by_sender.get((cents, account_iban), [])
+
+        best = None
+        for candidate in candidates:
+            other_key, other_day, other_iban = candidate[0], candidate[1], candidate[2]
+            if other_key in matched or other_iban == account_iban or abs(other_day - day) > TRANSFER_WINDOW_DAYS:
+                continue
+            if best is None or abs(other_day - day) < abs(best[1] - day):
+                best = candidate
+        if best is None:
+            continue
+
+        matched.add(best[0])
+        legs[key] = [transaction_date(tx), -cents]
+        legs[best[0]] = [transaction_date(best[3]), cents]
+        pairs.append((key, best[0], f'{cents / 100:.2f}', transaction_date(tx)))
+
+    return pairs, legs
+
+
+def update_transfers(instance_path, organisation_id, accounts):
+    """Match the organisation's accounts and record new internal transfers, return how many legs are new"""
+    pairs, legs = match_transfers(accounts)
+
+    with _index_lock:
+        index = load_index(instance_path, organisation_id)
+        known_legs = set(index['legs'])
+        amounts = index.setdefault('amounts', {})
+        new_legs = set(legs) - known_legs
+        # Legs recorded before amounts were kept get them when seen again
+        if not new_legs and all(key in amounts for key in legs):
+            return 0
+
+        known_pairs = {(p['out'], p['in']) for p in index['pairs']}
+        for out_key, in_key, amount, tx_date in pairs:
+            if (out_key, in_key) not in known_pairs:
+                index['pairs'].append({'out': out_key, 'in': in_key, 'amount': amount, 'date': tx_date})
+        index['legs'] = sorted(known_legs | set(legs))
+        amounts.update(legs)
+
+        index_path = _index_path(instance_path, organisation_id)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    return len(new_legs)
+
+
+def remove_account_transfers(instance_path, organisation_id, account_id):
+    """Forget the transfers of a deleted account, return how many legs were removed"""
+    prefix = f'{account_id}|'
+    with _index_lock:
+        index = load_index(instance_path, organisation_id)
+        removed_pairs = [p for p in index['pairs'] if p['out'].startswith(prefix) or p['in'].startswith(prefix)]
+        # The other leg of a pair was only internal because of this account
+        removed = {key for key in index['legs'] if key.startswith(prefix)}
+        removed |= {p['out'] for p in removed_pairs} | {p['in'] for p in removed_pairs}
+        removed &= set(index['legs'])
+        if not removed and not removed_pairs:
+            return 0
+
+        index['pairs'] = [p for p in index['pairs'] if p not in removed_pairs]
+        index['legs'] = [key for key in index['legs'] if key not in removed]
+        amounts = index.get('amounts', {})
+        for key in removed:
+            amounts.pop(key, None)
+
+        index_path = _index_path(instance_path, organisation_id)
+        tmp_path = index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        os.replace(tmp_path, index_path)
+
+    return len(removed)
+
+
+def update_user_transfers(instance_path, user_id, accounts_data):
+    """Match freshly synced accounts of a user against the other accounts of their organisation"""
+    user = db.get_user_row(user_id)
+    if user is None or not user['organisation_id']:
+        return 0
+
+    accounts = list(accounts_data)
+    for member_id in db.get_organisation_user_ids(user['organisation_id']):
+        if member_id == user_id:
+            continue
+        data_file = os.path.join(instance_path, f'account_data_{member_id}.json')
+        if os.path.exists(data_file):
+            try:
+                with open(data_file, 'r') as f:
+                    accounts.extend(json.load(f))
+            except json.JSONDecodeError:
+                continue
+
+    return update_transfers(instance_path, user['organisation_id'], accounts)
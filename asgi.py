@@ -0,0 +1,7 @@
+from asgiref.wsgi import WsgiToAsgi
+from app import create_app
+
+# ASGI entry point, e.g. `uvicorn asgi:application`. This is a compatibility shim:
+# Flask stays a WSGI app and each request still runs on a thread of its own
+app = create_app()
+application = WsgiToAsgi(app)
@@ -0,0 +1,96 @@
+"""
+Startup benchmark: measure the cold start of create_app() with python -X importtime.
+
+Usage:
+    python benchmark_startup.py                   # report only
+    python benchmark_startup.py --max-ms 400      # fail if startup is slower
+    python benchmark_startup.py --runs 5 --top 20
+
+Exits with status 1 when the median startup time exceeds --max-ms, or when a
+module that must stay lazy (see LAZY_MODULES) is imported during startup.
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+# Modules that must not be imported just by creating a web-only app
+LAZY_MODULES = ['apscheduler', 'nordigen', 'app.scheduler']
+
+STARTUP_CODE = "from app import create_app; create_app()"
+
+
+def run_once():
+    """Start a fresh interpreter, return (wall time in ms, importtime lines)"""
+    env = dict(os.environ, APP_MODE='web', PYTHONDONTWRITEBYTECODE='')
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [os.path.dirname(os.path.abspath(__file__)), env.get('PYTHONPATH')]))
+
+    start = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', STARTUP_CODE],
+        env=env, capture_output=True, text=True
+    )
+    elapsed = (time.perf_counter() - start) * 1000
+
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(f"Startup failed with exit code {result.returncode}")
+
+    return elapsed, [line for line in result.stderr.splitlines() if line.startswith('import time:')]
+
+
+def parse_importtime(lines):
+    """Parse importtime output into (module, self us, cumulative us, depth)"""
+    modules = []
+    for line in lines[1:]:  # first line is the header
+        parts = line[len('import time:'):].split('|')
+        self_us = int(parts[0])
+        cumulative_us = int(parts[1])
+        name = parts[2].rstrip()
+        depth = (len(name) - len(name.lstrip())) // 2
+        modules.append((name.strip(), self_us, cumulative_us, depth))
+    return modules
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--runs', type=int, default=3, help='number of cold starts to measure')
+    parser.add_argument('--top', type=int, default=15, help='number of slowest imports to show')
+    parser.add_argument('--max-ms', type=float, default=None, help='fail if the median startup exceeds this')
+    args = parser.parse_args()
+
+    timings = []
+    modules = []
+    for _ in range(args.runs):
+        elapsed, lines = run_once()
+        timings.append(elapsed)
+        modules = parse_importtime(lines)
+
+    median = statistics.median(timings)
+    import_total = sum(cumulative for _, _, cumulative, depth in modules if depth == 0) / 1000
+
+    print(f"Startup (wall, median of {args.runs}): {median:.1f} ms")
+    print(f"Imports (cumulative, last run):      {import_total:.1f} ms")
+    print("\nSlowest imports (self time):")
+    for name, self_us, cumulative_us, _ in sorted(modules, key=lambda m: m[1], reverse=True)[:args.top]:
+        print(f"  {self_us / 1000:8.1f} ms  {cumulative_us / 1000:8.1f} ms cumulative  {name}")
+
+    failed = False
+
+    imported = {name for name, _, _, _ in modules}
+    eager = [name for name in LAZY_MODULES if name in imported]
+    if eager:
+        print(f"\nError: modules imported at startup but expected to be lazy: {', '.join(eager)}")
+        failed = True
+
+    if args.max_ms is not None and median > args.max_ms:
+        print(f"\nError: startup took {median:.1f} ms, budget is {args.max_ms:.1f} ms")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
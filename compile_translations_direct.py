@@ -1,44 +1,95 @@
 """
 Direct script to compile translation files (.po to .mo)
+
+Catalogs are only recompiled when their .po file changed: a .mo file newer
+than its .po file is kept, and so is an older one when the content hash of
+the .po file matches the one recorded at the last compilation (e.g. after a
+fresh git checkout touched every file). Pass --force to recompile everything.
 """
 import os
 import sys
+import hashlib
+
+
+def file_hash(path):
+    """SHA-256 of a file's content"""
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def is_up_to_date(po_path, mo_path, hash_path, po_hash):
+    """Whether the .mo file was compiled from the current .po content"""
+    if not os.path.exists(mo_path):
+        return False
+
+    if not os.path.exists(hash_path):
+        # Compiled some other way (e.g. pybabel): trust the timestamps, and
+        # record the hash so the next checks don't depend on them
+        if os.path.getmtime(mo_path) < os.path.getmtime(po_path):
+            return False
+        with open(hash_path, 'w') as f:
+            f.write(po_hash)
+        return True
+
+    with open(hash_path, 'r') as f:
+        if f.read().strip() != po_hash:
+            return False
+    if os.path.getmtime(mo_path) < os.path.getmtime(po_path):
+        # Same content, only the timestamp moved: refresh the .mo timestamp
+        os.utime(mo_path)
+    return True
+
 
 try:
     print("Starting translation compilation...")
-    
+    force = '--force' in sys.argv[1:]
+
     # List all language directories
     translations_dir = "translations"
     print(f"Checking translations directory: {os.path.abspath(translations_dir)}")
-    
+
     lang_dirs = [d for d in os.listdir(translations_dir) if os.path.isdir(os.path.join(translations_dir, d))]
     print(f"Found language directories: {lang_dirs}")
-    
+
+    compiled = 0
+    skipped = 0
     for lang in lang_dirs:
         # Path to the .po file
         po_path = os.path.join(translations_dir, lang, "LC_MESSAGES", "messages.po")
         # Path for the .mo file to be created
         mo_path = os.path.join(translations_dir, lang, "LC_MESSAGES", "messages.mo")
-        
+        # Hash of the .po file the .mo file was compiled from
+        hash_path = os.path.join(translations_dir, lang, "LC_MESSAGES", "messages.po.sha256")
+
         if not os.path.exists(po_path):
             print(f"Warning: .po file not found at {po_path}")
             continue
-        
+
+        po_hash = file_hash(po_path)
+        if not force and is_up_to_date(po_path, mo_path, hash_path, po_hash):
+            print(f"Skipping {lang} translations: {mo_path} is up to date")
+            skipped += 1
+            continue
+
         print(f"Compiling {lang} translations: {po_path} -> {mo_path}")
-        
+
         # Import babel modules inside the function to get clear errors if they're not found
         try:
             from babel.messages.pofile import read_po
             from babel.messages.mofile import write_mo
-            
+
             with open(po_path, 'rb') as po_file:
                 catalog = read_po(po_file)
-            
+
             with open(mo_path, 'wb') as mo_file:
                 write_mo(mo_file, catalog)
-            
+
+            with open(hash_path, 'w') as hash_file:
+                hash_file.write(po_hash)
+
             print(f"Successfully compiled {lang} translations")
-            
+            compiled += 1
+
         except ImportError as e:
             print(f"Error importing Babel modules: {e}")
             print("Make sure Babel is installed: pip install babel")
@@ -47,9 +98,9 @@ try:
             print(f"Error compiling {lang} translations: {e}")
             import traceback
             traceback.print_exc()
-    
-    print("\nAll translations compiled successfully!")
-    
+
+    print(f"\nAll translations compiled successfully! ({compiled} compiled, {skipped} up to date)")
+
 except Exception as e:
     print(f"Unexpected error: {e}")
     import traceback